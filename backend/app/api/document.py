@@ -3,20 +3,24 @@
 """
 import os
 import uuid
+import hashlib
+import aiofiles
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, BackgroundTasks
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from backend.app.database import get_db, async_session_factory
 from backend.app.models.user import User
-from backend.app.models.document import Document, DocumentChunk, DocumentRole
+from backend.app.models.document import Document, DocumentChunk, DocumentRole, IngestionJob
 from backend.app.models.knowledge_base import KnowledgeBase
 from backend.app.models.model import Model
 from backend.app.models.system import Role
 from backend.app.schemas.document import DocumentResponse, ChunkResponse, DocumentPermissionResponse
 from backend.app.utils.auth import get_current_user
-from backend.app.services.doc_service import process_document
-from backend.app.core.vector_store import VectorStore
+from backend.app.services.ingestion_service import create_job, get_latest_job, ingestion_pool
+from backend.app.core.vector_store import get_vector_store
+from backend.app.core.answer_cache import answer_cache
+from backend.app.core.permission_scope import permission_scope_cache
 from backend.app.config import get_settings
 import backend.app.services.chat_service as chat_service
 from backend.app.core.rag_pipeline import RAGPipeline
@@ -30,7 +34,39 @@ from sqlalchemy import update
 
 router = APIRouter()
 settings = get_settings()
-vector_store = VectorStore()
+vector_store = get_vector_store()
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 上传文件分块写盘大小 (1MB)
+
+
+async def _save_upload(file: UploadFile, file_path: str, max_bytes: int) -> tuple:
+    """
+    分块流式写盘，边写边计算大小和 sha256，超过大小限制立即中止
+    (请求体此时已被框架落到临时文件，提前拒绝由 main.py 中的 Content-Length 预检完成)
+    返回: (文件大小, sha256)
+    """
+    # 临时文件大小已知时直接拒绝，不再复制
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(413, f"文件大小超过限制: {settings.MAX_FILE_SIZE_MB}MB")
+
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        async with aiofiles.open(file_path, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(413, f"文件大小超过限制: {settings.MAX_FILE_SIZE_MB}MB")
+                digest.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    return size, digest.hexdigest()
 
 
 @router.post("/initialize/{kb_id}", response_model=Response)
@@ -116,37 +152,26 @@ async def upload_document(
     file_id = str(uuid.uuid4())
     file_path = os.path.join(upload_dir, f"{file_id}{ext}")
 
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
+    file_size, file_hash = await _save_upload(
+        file, file_path, settings.MAX_FILE_SIZE_MB * 1024 * 1024
+    )
 
-    # 直接处理文档，处理成功后才返回响应
+    # 创建文档记录和入库任务，解析 / 向量化交给后台 worker，接口立即返回
     try:
-        # 1. 创建文档记录（状态为processing）
         doc = Document(
             id=file_id,
             kb_id=kb_id,
             filename=file.filename,
             file_path=file_path,
             file_type=ext.lstrip("."),
-            file_size=len(content),
-            status="processing",
+            file_size=file_size,
+            meta={"sha256": file_hash},
+            status="pending",
         )
         db.add(doc)
-        
-        # 2. 处理文档（包括分块、向量化等）
-        await process_document(db, file_id)
-        
-        # 3. 提交事务，只有处理成功才会保存到数据库
+        job = await create_job(db, doc)
         await db.commit()
-        
-        return Response(data={
-            "message": "文档上传成功",
-            "file_id": file_id,
-            "filename": file.filename
-        })
     except Exception as e:
-        # 如果处理失败，回滚事务
         await db.rollback()
         # 清理上传的文件
         if os.path.exists(file_path):
@@ -154,7 +179,80 @@ async def upload_document(
         logger.error(f"文档上传失败: {e}")
         raise HTTPException(500, f"文档上传失败: {str(e)}")
 
+    ingestion_pool.submit(job.id)
+
+    return Response(data={
+        "message": "文档上传成功，正在后台处理",
+        "file_id": file_id,
+        "filename": file.filename,
+        "job_id": job.id,
+        "status": doc.status,
+    })
+
+
+async def _get_owned_document(db: AsyncSession, doc_id: str, user: User) -> Document:
+    """获取文档并校验当前用户是知识库所有者"""
+    result = await db.execute(select(Document).where(Document.id == doc_id, Document.is_deleted == False))
+    doc = result.scalar_one_or_none()
+    if not doc:
+        raise HTTPException(404, "文档不存在")
+
+    kb_result = await db.execute(
+        select(KnowledgeBase).where(KnowledgeBase.id == doc.kb_id, KnowledgeBase.is_deleted == False)
+    )
+    kb = kb_result.scalar_one_or_none()
+    if not kb or kb.owner_id != user.id:
+        raise HTTPException(404, "知识库不存在")
+    return doc
+
 
+@router.get("/{doc_id}/progress", response_model=Response)
+async def get_document_progress(
+    doc_id: str,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """查询文档入库进度"""
+    doc = await _get_owned_document(db, doc_id, user)
+    job = await get_latest_job(db, doc_id)
+
+    return Response(data={
+        "doc_id": doc.id,
+        "status": doc.status,
+        "job_id": job.id if job else None,
+        "job_status": job.status if job else None,
+        "stage": job.stage if job else None,
+        "progress": job.progress if job else (100 if doc.status == "completed" else 0),
+        "attempts": job.attempts if job else 0,
+        "error_msg": (job.error_msg if job else None) or doc.error_msg,
+        "metrics": job.metrics if job else None,
+    })
+
+
+@router.post("/{doc_id}/retry", response_model=Response)
+async def retry_document(
+    doc_id: str,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    """重新处理入库失败的文档"""
+    doc = await _get_owned_document(db, doc_id, user)
+    if doc.status != "failed":
+        raise HTTPException(400, "只能重试处理失败的文档")
+    if not os.path.exists(doc.file_path):
+        raise HTTPException(400, "源文件已不存在，请重新上传")
+
+    job = await get_latest_job(db, doc_id)
+    if job is None or job.status in ("completed", "cancelled"):
+        job = await create_job(db, doc)
+    job.status = "queued"
+    job.error_msg = None
+    doc.status = "pending"
+    doc.error_msg = None
+    await db.commit()
+
+    ingestion_pool.submit(job.id)
+    return Response(data={"message": "已重新提交处理", "job_id": job.id})
 
 
 @router.get("/list/{kb_id}", response_model=Response)
@@ -296,7 +394,12 @@ async def delete_document(
     user: User = Depends(get_current_user),
 ):
     """删除文档"""
-    result = await db.execute(select(Document).where(Document.id == doc_id, Document.is_deleted == False))
+    # 锁定文档行 (FOR NO KEY UPDATE，不阻塞入库时分块外键的 KEY SHARE 锁):
+    # 与入库任务提交前的检查互斥，读到的 chunk_count 是已提交的最新值
+    result = await db.execute(
+        select(Document).where(Document.id == doc_id, Document.is_deleted == False)
+        .with_for_update(key_share=True)
+    )
     doc = result.scalar_one_or_none()
     if not doc:
         raise HTTPException(404, "文档不存在")
@@ -313,8 +416,16 @@ async def delete_document(
     if kb.owner_id != user.id:
         raise HTTPException(403, "只有知识库所有者可以删除文档")
 
-    # 删除向量
+    # 取消排队 / 执行中的入库任务 (执行中的任务在写入前检查到删除后自行中止并清理向量)
+    await db.execute(
+        update(IngestionJob)
+        .where(IngestionJob.doc_id == doc_id, IngestionJob.status.in_(("queued", "running")))
+        .values(status="cancelled", finished_at=datetime.utcnow())
+    )
+
+    # 删除向量 (向量删除即生效，不依赖后续提交是否成功，立即使问答缓存失效)
     vector_store.delete_by_doc(doc.kb_id, doc.id)
+    await answer_cache.invalidate_kb(doc.kb_id)
 
     # 删除文件
     if os.path.exists(doc.file_path):
@@ -337,20 +448,19 @@ async def delete_document(
         .values(is_deleted=True)
     )
 
-    kb_result = await db.execute(
-        select(KnowledgeBase).where(KnowledgeBase.id == doc.kb_id)
-    )
-    kb = kb_result.scalar_one_or_none()
-    if kb:
-        # 重新计算，只统计未删除的文档
-        count_result = await db.execute(
-            select(Document).where(Document.kb_id == doc.kb_id, Document.is_deleted == False)
+    # 更新知识库统计: 只有处理成功 (有分块) 的文档计入统计，原子减量更新
+    if doc.chunk_count:
+        await db.execute(
+            update(KnowledgeBase)
+            .where(KnowledgeBase.id == doc.kb_id)
+            .values(
+                doc_count=KnowledgeBase.doc_count - 1,
+                chunk_count=KnowledgeBase.chunk_count - doc.chunk_count,
+            )
         )
-        all_docs = count_result.scalars().all()
-        kb.doc_count = len(all_docs)
-        kb.chunk_count = sum(d.chunk_count for d in all_docs)
 
     await db.commit()
+    permission_scope_cache.invalidate(doc.kb_id)
     return Response(data={"message": "已删除"})
 
 
@@ -462,6 +572,7 @@ async def add_document_permission(
         db.add(doc_role)
     
     await db.commit()
+    permission_scope_cache.invalidate(doc.kb_id)
     
     return Response(data={"message": "权限添加成功"})
 
@@ -505,4 +616,5 @@ async def remove_document_permission(
         raise HTTPException(404, "权限不存在")
     
     await db.commit()
+    permission_scope_cache.invalidate(doc.kb_id)
     return Response(data={"message": "权限移除成功"})
\ No newline at end of file
@@ -256,7 +256,7 @@ def calculate_relevance(answer: str, query: str) -> float:
 
 async def calculate_factuality(answer: str, kb_id: str, model=None) -> float:
     """计算事实性评分，检测AI回答中是否有幻觉内容"""
-    from backend.app.core.vector_store import VectorStore
+    from backend.app.core.vector_store import get_vector_store
     from backend.app.models.model import Model
     from sqlalchemy import select
     from backend.app.database import async_session_factory
@@ -293,7 +293,7 @@ async def calculate_factuality(answer: str, kb_id: str, model=None) -> float:
             api_key = embedding_model.api_key if embedding_model else None
             base_url = embedding_model.base_url if embedding_model else None
             model_name = embedding_model.model if embedding_model else None
-            vector_store = VectorStore(api_key, base_url, model_name, embedding_model)
+            vector_store = get_vector_store(api_key, base_url, model_name, embedding_model)
             factuality_score = 0.0
             checked_statements = 0
 
@@ -15,13 +15,15 @@ from backend.app.models.tag import Tag
 from backend.app.models.domain import Domain
 from backend.app.schemas.knowledge_base import KBCreate, KBUpdate, KBResponse
 from backend.app.utils.auth import get_current_user
-from backend.app.core.vector_store import VectorStore
+from backend.app.core.vector_store import get_vector_store
+from backend.app.core.answer_cache import answer_cache
+from backend.app.core.permission_scope import permission_scope_cache
 from sqlalchemy import select
 from backend.app.models.system import Role
 from backend.app.models.knowledge_base import KnowledgeBaseRole
 
 router = APIRouter()
-vector_store = VectorStore()
+vector_store = get_vector_store()
 
 
 async def validate_model_active(db: AsyncSession, model_name: str, model_type: str) -> Optional[Model]:
@@ -463,11 +465,13 @@ async def delete_kb(
     if not kb or kb.owner_id != user.id:
         raise HTTPException(404, "知识库不存在")
 
-    # 删除向量库
+    # 删除向量库 (立即生效，问答缓存随之失效)
     vector_store.delete_collection(kb_id)
+    await answer_cache.invalidate_kb(kb_id)
     # 伪删除：将is_deleted字段设置为True
     kb.is_deleted = True
     await db.commit()
+    permission_scope_cache.invalidate(kb_id)
     return Response(data={"message": "已删除"})
 
 
@@ -567,6 +571,7 @@ async def add_kb_permission(
         db.add(kb_role)
     
     await db.commit()
+    permission_scope_cache.invalidate(kb_id)
     
     return Response(data={"message": "权限添加成功"})
 
@@ -604,4 +609,5 @@ async def remove_kb_permission(
         raise HTTPException(404, "权限不存在")
     
     await db.commit()
+    permission_scope_cache.invalidate(kb_id)
     return Response(data={"message": "权限移除成功"})
\ No newline at end of file
@@ -1,7 +1,7 @@
 """
 SmartRAG 全局配置
 """
-from typing import Optional
+from typing import Optional, Dict
 from pydantic_settings import BaseSettings
 from functools import lru_cache
 
@@ -31,23 +31,79 @@ class Settings(BaseSettings):
     UPLOAD_DIR: str = "D:\\code\\github\\smart_rag\\backend\\uploads"
     MAX_FILE_SIZE_MB: int = 100
 
+    # ---- 文档入库任务 ----
+    INGESTION_WORKERS: int = 2  # 后台入库 worker 数
+    INGESTION_JOB_LEASE: int = 120       # 任务租约 (秒)，running 任务超过该时间没有心跳才会被其他进程接管
+    INGESTION_POLL_INTERVAL: int = 30    # 扫描待执行 / 租约过期任务的间隔 (秒)
+    PARSE_EXECUTOR_MODE: str = "thread"  # 解析 / 分块执行方式: thread / process
+    PARSE_WORKERS: int = 2               # process 模式下同时运行的解析进程数
+    PARSE_TIMEOUT: int = 600             # 单个文档解析超时 (秒，0 为不限制)
+    PARSE_MEMORY_LIMIT_MB: int = 2048    # process 模式下单个解析进程内存上限 (0 为不限制，仅 POSIX)
+    PDF_PARSE_WORKERS: int = 4           # 大 PDF 按页区间并行解析的进程数
+    PDF_PARALLEL_MIN_PAGES: int = 50     # 超过该页数才并行解析
+    PDF_STREAM_BATCH_PAGES: int = 20     # PDF 每批解析的页数 (并行 / 流式解析的单位)
+    INGESTION_BATCH_SIZE: int = 64       # 流式入库时每批向量化 / 写库的分块数
+    INGESTION_QUEUE_SIZE: int = 2        # 入库流水线各阶段之间的队列长度 (批)
+
     # ---- ChromaDB ----
     # CHROMA_PERSIST_DIR: str = "E:\\ai_code\\github workplace\\zzwzz_rag\\backend\\chroma_data"
     CHROMA_PERSIST_DIR: str = "D:\\code\\smart_rag\\backend\\chroma_data"
+    COLLECTION_COUNT_CACHE_TTL: int = 30  # Collection 文档数缓存 (秒)，其他进程的写入最多延迟这么久可见
+
+    # ---- BM25 倒排索引 ----
+    BM25_INDEX_DIR: str = "D:\\code\\smart_rag\\backend\\bm25_index"
+    BM25_HOT_KB_CACHE_SIZE: int = 32   # 常驻内存的热知识库数量
+
+    # ---- Embedding 持久化存储 (按内容哈希复用向量) ----
+    EMBEDDING_STORE_DIR: str = "D:\\code\\smart_rag\\backend\\embedding_store"
 
     # ---- LLM ----
     EMBEDDING_DIMENSION: int = 1536
     LLM_TEMPERATURE: float = 0.1
     LLM_MAX_TOKENS: int = 4096
+    LLM_CLIENT_CACHE_SIZE: int = 32  # 共享的 LLM 客户端数 (按 api_key + base_url)
+    LLM_CLIENT_CLOSE_GRACE: int = 600  # 被淘汰的 LLM 客户端延迟关闭秒数 (等在途请求 / 流式输出结束)
+    GENERATION_RELEVANCE_MODE: str = "single"  # 相关性判断方式: single (与回答合并为一次调用) / two_step
 
     # ---- 检索 ----
     CHUNK_SIZE: int = 512
     CHUNK_OVERLAP: int = 64
+    CHUNK_TOKENIZER_THREADS: int = 4   # 分块批量计数 token 的线程数
     RETRIEVAL_TOP_K: int = 10          # 粗检索数
     RERANK_TOP_K: int = 5             # 精排后保留数
     SIMILARITY_THRESHOLD: float = 0.2  # 最低相关性阈值
     ENABLE_QUERY_REWRITE: bool = True   # 是否进行查询的改写扩写
     ENABLE_RERANK: bool = True         # 是否进行rerank
+    KEYWORD_SEARCH_WORKERS: int = 4    # BM25 检索线程池大小
+    RETRIEVAL_KB_CONCURRENCY: int = 4  # 多知识库并发检索上限
+    LOG_RETRIEVAL_SAMPLES: bool = False  # 检索时打印知识库文档示例 (调试用)
+
+    # ---- 查询向量缓存 ----
+    QUERY_EMBEDDING_CACHE_SIZE: int = 10000   # 进程内 LRU 容量
+    QUERY_EMBEDDING_CACHE_TTL: int = 3600     # 秒
+    QUERY_EMBEDDING_CACHE_REDIS: bool = False  # 是否启用 Redis 二级缓存 (REDIS_URL)
+
+    # ---- 问答结果缓存 ----
+    # 默认关闭。多进程 / 多实例部署必须使用 redis 后端：memory 后端的知识库版本号只在本进程内递增，
+    # 其他进程中入库 / 删除文档后本进程的缓存不会失效，会返回过期答案，仅适用于单进程部署
+    ANSWER_CACHE_ENABLED: bool = False
+    ANSWER_CACHE_BACKEND: str = "redis"      # redis (REDIS_URL) / memory (仅单进程)
+    ANSWER_CACHE_SIMILARITY: float = 0.95    # 查询向量余弦相似度阈值
+    ANSWER_CACHE_TTL: int = 1800             # 秒
+    ANSWER_CACHE_MAX_SCOPES: int = 1000      # 进程内缓存的范围数 (模型 + 知识库 + 权限)
+    ANSWER_CACHE_MAX_ENTRIES: int = 200      # 每个范围最多缓存的问答数
+
+    # ---- 检索权限范围缓存 ----
+    PERMISSION_SCOPE_CACHE_SIZE: int = 1024  # 缓存的 (角色, 知识库集合) 数
+    PERMISSION_SCOPE_CACHE_TTL: int = 300    # 秒 (权限接口会主动失效，TTL 兜底其他进程的变更)
+
+    # ---- Embedding 请求 ----
+    EMBEDDING_MAX_CONCURRENCY: int = 4          # 同时在途的批量请求数
+    EMBEDDING_DEFAULT_RATE_LIMIT: float = 10.0  # 每个提供方默认每秒请求数 (0 为不限速)
+    EMBEDDING_RATE_LIMITS: Dict[str, float] = {}  # 按 base_url 单独配置的每秒请求数
+    EMBEDDING_MAX_RETRIES: int = 5              # 429 / 5xx 重试次数
+    EMBEDDING_RETRY_MAX_DELAY: float = 30.0     # 单次退避最长等待 (秒)
+    EMBEDDING_SERVICE_CACHE_SIZE: int = 16      # 按模型缓存的 Embedding 服务实例数
 
     # ---- 本地 Embedding (可选) ----
     USE_LOCAL_EMBEDDING: bool = False
@@ -0,0 +1,220 @@
+"""
+SmartRAG 问答结果缓存
+- 范围 key: (生成模型, 知识库及其版本号, 有权限的文档集合指纹, 检索参数)
+- 范围内按查询向量的余弦相似度匹配，超过阈值即命中 (相近问法复用同一答案)
+- 文档入库 / 删除时递增所属知识库的版本号，旧版本下的缓存不再命中，随 TTL 过期
+- 后端: Redis (多进程 / 多实例共享，REDIS_URL) / 进程内 LRU (memory，仅单进程部署)
+- Redis 不可用时不会退回 memory 后端 (版本号不跨进程，多进程下会返回过期答案)，缓存直接关闭
+"""
+import json
+import time
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from typing import List, Optional, Dict
+from loguru import logger
+
+from backend.app.config import get_settings
+
+settings = get_settings()
+
+
+class MemoryAnswerCacheBackend:
+    """进程内后端 - 按范围 LRU 淘汰，每个范围保留最近的若干条问答"""
+
+    def __init__(self, max_scopes: int, max_entries: int):
+        self.max_scopes = max_scopes
+        self.max_entries = max(1, max_entries)
+        self._scopes: "OrderedDict[str, List[dict]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+
+    async def get_generations(self, kb_ids: List[str]) -> Dict[str, int]:
+        return {kb_id: self._generations.get(kb_id, 0) for kb_id in kb_ids}
+
+    async def bump_generation(self, kb_id: str):
+        self._generations[kb_id] = self._generations.get(kb_id, 0) + 1
+
+    async def load(self, scope: str) -> List[dict]:
+        entries = self._scopes.get(scope)
+        if entries is None:
+            return []
+        self._scopes.move_to_end(scope)
+        return entries
+
+    async def append(self, scope: str, entry: dict, ttl: int):
+        now = time.time()
+        entries = [e for e in self._scopes.get(scope, []) if e["expires_at"] > now]
+        entries.append(entry)
+        self._scopes[scope] = entries[-self.max_entries:]
+        self._scopes.move_to_end(scope)
+        while len(self._scopes) > self.max_scopes:
+            self._scopes.popitem(last=False)
+
+    def size(self) -> int:
+        return sum(len(entries) for entries in self._scopes.values())
+
+
+class RedisAnswerCacheBackend:
+    """Redis 后端 - 每个范围一个 list，知识库版本号用 INCR 维护 (不过期)"""
+
+    def __init__(self, redis_url: str, max_entries: int):
+        import redis.asyncio as aioredis
+        self._redis = aioredis.from_url(redis_url)
+        self.max_entries = max_entries
+
+    @staticmethod
+    def _generation_key(kb_id: str) -> str:
+        return f"smartrag:answer:gen:{kb_id}"
+
+    @staticmethod
+    def _scope_key(scope: str) -> str:
+        return f"smartrag:answer:{scope}"
+
+    async def get_generations(self, kb_ids: List[str]) -> Dict[str, int]:
+        if not kb_ids:
+            return {}
+        values = await self._redis.mget([self._generation_key(kb_id) for kb_id in kb_ids])
+        return {kb_id: int(v) if v else 0 for kb_id, v in zip(kb_ids, values)}
+
+    async def bump_generation(self, kb_id: str):
+        await self._redis.incr(self._generation_key(kb_id))
+
+    async def load(self, scope: str) -> List[dict]:
+        raw = await self._redis.lrange(self._scope_key(scope), 0, -1)
+        return [json.loads(item) for item in raw]
+
+    async def append(self, scope: str, entry: dict, ttl: int):
+        key = self._scope_key(scope)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, json.dumps(entry, ensure_ascii=False))
+            pipe.ltrim(key, -self.max_entries, -1)
+            pipe.expire(key, ttl)
+            await pipe.execute()
+
+    def size(self) -> int:
+        return -1  # Redis 后端不统计
+
+
+class AnswerCache:
+    """问答结果缓存 (语义近邻匹配)"""
+
+    def __init__(self, backend, threshold: float = 0.95, ttl: int = 1800):
+        self.backend = backend
+        self.enabled = backend is not None
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def make_scope(
+        self,
+        model: str,
+        kb_ids: List[str],
+        doc_ids: Optional[List[str]],
+        **options,
+    ) -> Optional[str]:
+        """
+        计算缓存范围 key
+        kb_ids / doc_ids 为权限过滤后的知识库和文档 (doc_ids 为 None 表示不按文档过滤)
+        缓存关闭时返回 None
+        """
+        if not self.enabled:
+            return None
+        try:
+            generations = await self.backend.get_generations(sorted(kb_ids))
+        except Exception as e:
+            logger.warning(f"Answer cache generations unavailable: {e}")
+            return None
+        doc_fingerprint = (
+            hashlib.sha256("\x00".join(sorted(doc_ids)).encode("utf-8")).hexdigest()
+            if doc_ids is not None else None
+        )
+        payload = json.dumps(
+            {
+                "model": model,
+                "kbs": sorted(generations.items()),
+                "docs": doc_fingerprint,
+                "options": options,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    async def lookup(self, scope: str, embedding: List[float]) -> Optional[dict]:
+        """在范围内查找与查询向量最相近且未过期的答案"""
+        try:
+            entries = await self.backend.load(scope)
+        except Exception as e:
+            logger.warning(f"Answer cache lookup failed: {e}")
+            return None
+
+        now = time.time()
+        entries = [e for e in entries if e["expires_at"] > now]
+        if entries:
+            matrix = np.asarray([e["embedding"] for e in entries], dtype=np.float32)
+            scores = matrix @ self._normalize(embedding)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                self.hits += 1
+                logger.info(f"[AnswerCache] hit: similarity={scores[best]:.4f}")
+                return entries[best]["result"]
+        self.misses += 1
+        return None
+
+    async def store(self, scope: str, embedding: List[float], result: dict):
+        entry = {
+            "embedding": self._normalize(embedding).tolist(),
+            "result": result,
+            "expires_at": time.time() + self.ttl,
+        }
+        try:
+            await self.backend.append(scope, entry, self.ttl)
+        except Exception as e:
+            logger.warning(f"Answer cache store failed: {e}")
+
+    async def invalidate_kb(self, kb_id: str):
+        """知识库文档变更后调用，使该知识库相关的缓存全部失效"""
+        if not self.enabled:
+            return
+        try:
+            await self.backend.bump_generation(kb_id)
+        except Exception as e:
+            logger.warning(f"Answer cache invalidation failed for kb {kb_id}: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": self.backend.size() if self.enabled else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def _create_backend():
+    """按配置创建后端，未启用或 Redis 不可用时返回 None (缓存关闭)"""
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    if settings.ANSWER_CACHE_BACKEND == "memory":
+        logger.info("Answer cache uses in-process memory backend (single-process deployments only)")
+        return MemoryAnswerCacheBackend(settings.ANSWER_CACHE_MAX_SCOPES, settings.ANSWER_CACHE_MAX_ENTRIES)
+    try:
+        return RedisAnswerCacheBackend(settings.REDIS_URL, settings.ANSWER_CACHE_MAX_ENTRIES)
+    except Exception as e:
+        logger.warning(f"Redis answer cache unavailable, answer cache disabled: {e}")
+        return None
+
+
+answer_cache = AnswerCache(
+    _create_backend(),
+    threshold=settings.ANSWER_CACHE_SIMILARITY,
+    ttl=settings.ANSWER_CACHE_TTL,
+)
@@ -0,0 +1,345 @@
+"""
+SmartRAG BM25 倒排索引
+- 按知识库隔离的持久化倒排索引 (SQLite)
+- term → postings、文档长度、DF 统计
+- 支持增量写入 / 按文档删除，查询只读取查询词的 postings
+"""
+import os
+import math
+import heapq
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Tuple, Iterable
+from loguru import logger
+import jieba
+
+from backend.app.config import get_settings
+
+settings = get_settings()
+
+
+def tokenize(text: str) -> List[str]:
+    """BM25 分词 (jieba 精确模式，去掉空白词)"""
+    return [w for w in jieba.cut(text) if w.strip()]
+
+
+class BM25Index:
+    """单个知识库的 BM25 倒排索引"""
+
+    def __init__(
+        self,
+        kb_id: str,
+        path: str,
+        k1: float = 1.5,
+        b: float = 0.75,
+        postings_cache_size: int = 4096,
+    ):
+        self.kb_id = kb_id
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        # 热数据缓存: 统计信息 + 最近查询词的 postings
+        # 本连接写入时失效；其他连接 (其他进程) 提交写入后按 data_version 变化失效
+        self._stats_cache: Optional[Tuple[int, int]] = None
+        self._postings_cache: "OrderedDict[str, Tuple[int, list]]" = OrderedDict()
+        self._postings_cache_size = postings_cache_size
+        self._data_version: Optional[int] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._ensure_open()
+        self._init_schema()
+
+    def _ensure_open(self):
+        """打开连接 (被热知识库 LRU 淘汰后释放的连接在再次使用时重新打开)"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._invalidate()
+
+    @contextmanager
+    def _transaction(self):
+        """持有锁的写事务 (连接被释放过时先重新打开)"""
+        with self._lock:
+            self._ensure_open()
+            with self._conn:
+                yield
+
+    def _init_schema(self):
+        with self._transaction():
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS docs (
+                    chunk_id TEXT PRIMARY KEY,
+                    doc_id   TEXT,
+                    length   INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_docs_doc_id ON docs(doc_id);
+                CREATE TABLE IF NOT EXISTS postings (
+                    term     TEXT NOT NULL,
+                    chunk_id TEXT NOT NULL,
+                    tf       INTEGER NOT NULL,
+                    PRIMARY KEY (term, chunk_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings(chunk_id);
+                CREATE TABLE IF NOT EXISTS terms (
+                    term TEXT PRIMARY KEY,
+                    df   INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS stats (
+                    key   TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO stats(key, value) VALUES ('doc_count', 0), ('total_length', 0);
+                INSERT OR IGNORE INTO stats(key, value) VALUES ('backfilled', 0);
+                """
+            )
+
+    # ───────── 统计 ─────────
+    def _sync(self):
+        """其他连接提交过写入时 (data_version 变化) 丢弃缓存 (调用方持有锁)"""
+        self._ensure_open()
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._invalidate()
+
+    def _stats(self) -> Tuple[int, int]:
+        self._sync()
+        if self._stats_cache is None:
+            rows = dict(self._conn.execute("SELECT key, value FROM stats").fetchall())
+            self._stats_cache = (rows.get("doc_count", 0), rows.get("total_length", 0))
+        return self._stats_cache
+
+    def _invalidate(self):
+        self._stats_cache = None
+        self._postings_cache.clear()
+
+    def _load_postings(self, term: str) -> Optional[Tuple[int, list]]:
+        """读取某个词的 (df, postings)，命中内存缓存时不访问磁盘"""
+        cached = self._postings_cache.get(term)
+        if cached is not None:
+            self._postings_cache.move_to_end(term)
+            return cached
+
+        row = self._conn.execute(
+            "SELECT df FROM terms WHERE term = ?", (term,)
+        ).fetchone()
+        if row is None:
+            return None
+        postings = self._conn.execute(
+            "SELECT p.chunk_id, p.tf, d.length, d.doc_id "
+            "FROM postings p JOIN docs d ON d.chunk_id = p.chunk_id "
+            "WHERE p.term = ?",
+            (term,),
+        ).fetchall()
+
+        entry = (row[0], postings)
+        self._postings_cache[term] = entry
+        if len(self._postings_cache) > self._postings_cache_size:
+            self._postings_cache.popitem(last=False)
+        return entry
+
+    @property
+    def doc_count(self) -> int:
+        with self._lock:
+            return self._stats()[0]
+
+    @property
+    def backfilled(self) -> bool:
+        """是否已从 Collection 回填过存量分块 (索引上线前写入的数据)"""
+        with self._lock:
+            self._ensure_open()
+            row = self._conn.execute("SELECT value FROM stats WHERE key = 'backfilled'").fetchone()
+            return bool(row and row[0])
+
+    def mark_backfilled(self):
+        with self._transaction():
+            self._conn.execute("UPDATE stats SET value = 1 WHERE key = 'backfilled'")
+
+    # ───────── 写入 ─────────
+    def add(
+        self,
+        chunk_ids: List[str],
+        doc_ids: List[Optional[str]],
+        contents: Optional[List[str]] = None,
+        tokens: Optional[List[List[str]]] = None,
+    ):
+        """
+        增量写入分块 (已存在的 chunk_id 会先删除再写入)
+        tokens 为入库时预先计算好的分词结果；未提供时才对 contents 分词
+        """
+        if not chunk_ids:
+            return
+
+        token_lists = tokens if tokens is not None else [tokenize(c) for c in contents]
+
+        with self._transaction():
+            self._invalidate()
+            self._delete_chunks(chunk_ids)
+
+            doc_rows = []
+            posting_rows = []
+            df_delta: Counter = Counter()
+            total_length = 0
+            for chunk_id, doc_id, chunk_tokens in zip(chunk_ids, doc_ids, token_lists):
+                tf = Counter(chunk_tokens)
+                doc_rows.append((chunk_id, doc_id, len(chunk_tokens)))
+                posting_rows.extend((term, chunk_id, n) for term, n in tf.items())
+                df_delta.update(tf.keys())
+                total_length += len(chunk_tokens)
+
+            self._conn.executemany(
+                "INSERT INTO docs(chunk_id, doc_id, length) VALUES (?, ?, ?)", doc_rows
+            )
+            self._conn.executemany(
+                "INSERT INTO postings(term, chunk_id, tf) VALUES (?, ?, ?)", posting_rows
+            )
+            self._conn.executemany(
+                "INSERT INTO terms(term, df) VALUES (?, ?) "
+                "ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+                df_delta.items(),
+            )
+            self._bump_stats(len(doc_rows), total_length)
+
+        logger.info(f"BM25 index kb_{self.kb_id}: added {len(chunk_ids)} chunks")
+
+    def delete_by_doc(self, doc_id: str):
+        """删除某个文档的全部分块"""
+        with self._transaction():
+            chunk_ids = [
+                row[0] for row in self._conn.execute(
+                    "SELECT chunk_id FROM docs WHERE doc_id = ?", (doc_id,)
+                )
+            ]
+            self._invalidate()
+            self._delete_chunks(chunk_ids)
+        logger.info(f"BM25 index kb_{self.kb_id}: deleted {len(chunk_ids)} chunks of doc {doc_id}")
+
+    def _delete_chunks(self, chunk_ids: Iterable[str]):
+        """删除分块并回收 DF / 长度统计 (调用方持有锁和事务)"""
+        removed_docs = 0
+        removed_length = 0
+        for chunk_id in chunk_ids:
+            row = self._conn.execute(
+                "SELECT length FROM docs WHERE chunk_id = ?", (chunk_id,)
+            ).fetchone()
+            if row is None:
+                continue
+            terms = [
+                (r[0],) for r in self._conn.execute(
+                    "SELECT term FROM postings WHERE chunk_id = ?", (chunk_id,)
+                )
+            ]
+            self._conn.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", terms)
+            self._conn.execute("DELETE FROM postings WHERE chunk_id = ?", (chunk_id,))
+            self._conn.execute("DELETE FROM docs WHERE chunk_id = ?", (chunk_id,))
+            removed_docs += 1
+            removed_length += row[0]
+
+        if removed_docs:
+            self._conn.execute("DELETE FROM terms WHERE df <= 0")
+            self._bump_stats(-removed_docs, -removed_length)
+
+    def _bump_stats(self, doc_delta: int, length_delta: int):
+        self._conn.execute(
+            "UPDATE stats SET value = value + ? WHERE key = 'doc_count'", (doc_delta,)
+        )
+        self._conn.execute(
+            "UPDATE stats SET value = value + ? WHERE key = 'total_length'", (length_delta,)
+        )
+
+    # ───────── 查询 ─────────
+    def search(
+        self,
+        query_terms: Dict[str, float],
+        top_k: int,
+        doc_ids: Optional[List[str]] = None,
+    ) -> List[Tuple[str, float]]:
+        """
+        BM25 打分，仅读取查询词的 postings
+        query_terms: {term: 权重}，权重等价于该词在查询中重复出现的次数
+        返回: [(chunk_id, score)] 按分数降序
+        """
+        if not query_terms:
+            return []
+
+        allowed = set(doc_ids) if doc_ids else None
+
+        with self._lock:
+            n_docs, total_length = self._stats()
+            if n_docs == 0:
+                return []
+            avgdl = total_length / n_docs or 1.0
+
+            scores: Dict[str, float] = {}
+            for term, weight in query_terms.items():
+                entry = self._load_postings(term)
+                if entry is None:
+                    continue
+                df, postings = entry
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+
+                for chunk_id, tf, length, doc_id in postings:
+                    if allowed is not None and doc_id not in allowed:
+                        continue
+                    norm = tf * (self.k1 + 1) / (
+                        tf + self.k1 * (1 - self.b + self.b * length / avgdl)
+                    )
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + weight * idf * norm
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])
+
+    def release(self):
+        """释放连接 (等待执行中的读写结束)，之后再使用时自动重新打开"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+
+
+# ───────── 索引管理 (热知识库 LRU) ─────────
+_indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _index_path(kb_id: str) -> str:
+    return os.path.join(settings.BM25_INDEX_DIR, f"kb_{kb_id.replace('-', '_')}.sqlite3")
+
+
+def get_bm25_index(kb_id: str) -> BM25Index:
+    """获取 (必要时打开) 知识库的 BM25 索引，最近使用的知识库常驻内存"""
+    with _indexes_lock:
+        index = _indexes.get(kb_id)
+        if index is not None:
+            _indexes.move_to_end(kb_id)
+            return index
+
+        os.makedirs(settings.BM25_INDEX_DIR, exist_ok=True)
+        index = BM25Index(kb_id, _index_path(kb_id))
+        _indexes[kb_id] = index
+        # 淘汰最久未使用的知识库并释放连接 (仍持有该对象的调用方再次使用时会重新打开)
+        while len(_indexes) > settings.BM25_HOT_KB_CACHE_SIZE:
+            evicted_kb_id, evicted = _indexes.popitem(last=False)
+            evicted.release()
+            logger.info(f"BM25 index kb_{evicted_kb_id} evicted from hot cache")
+        return index
+
+
+def drop_bm25_index(kb_id: str):
+    """删除知识库的 BM25 索引文件"""
+    with _indexes_lock:
+        index = _indexes.pop(kb_id, None)
+        if index is not None:
+            index.close()
+        path = _index_path(kb_id)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
@@ -6,12 +6,36 @@ SmartRAG 自适应智能分块器
 """
 import re
 import uuid
-from typing import List, Optional
+import bisect
+import threading
+from typing import List, Optional, Iterator, Iterable, Tuple
 from dataclasses import dataclass, field
 from loguru import logger
 import tiktoken
 
-from backend.app.core.document_parser import ParsedDocument
+from backend.app.config import get_settings
+from backend.app.core.document_parser import ParsedDocument, StreamedDocument, PAGE_SEPARATOR
+
+settings = get_settings()
+
+PARAGRAPH_SEPARATOR = re.compile(r'\n\s*\n')
+SENTENCE_SEPARATOR = re.compile(r'(?<=[。！？.!?])\s*')
+
+# tiktoken 编码表加载开销较大，所有分块器共享一份
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """获取共享的 tiktoken 编码器"""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            try:
+                _tokenizer = tiktoken.encoding_for_model("gpt-4o")
+            except Exception:
+                _tokenizer = tiktoken.get_encoding("cl100k_base")
+        return _tokenizer
 
 
 @dataclass
@@ -20,7 +44,7 @@ class Chunk:
     id: str = field(default_factory=lambda: str(uuid.uuid4()))
     content: str = ""
     chunk_index: int = 0
-    token_count: int = 0
+    token_count: int = 0  # 分块时累加得到的 token 数，0 表示未计算
     metadata: dict = field(default_factory=dict)
     parent_id: Optional[str] = None  # 父块ID，用于父子分块结构
 
@@ -37,14 +61,34 @@ class SmartChunker:
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
         self.min_chunk_size = min_chunk_size
-        try:
-            self.tokenizer = tiktoken.encoding_for_model("gpt-4o")
-        except Exception:
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self._sep_token_cache = {}
+        self.tokenizer = get_tokenizer()
 
     def count_tokens(self, text: str) -> int:
         return len(self.tokenizer.encode(text))
 
+    def _fill_token_counts(self, chunks: List[Chunk]):
+        """为分块阶段没有算出 token 数的块批量计数 (encode_batch 多线程编码)"""
+        missing = [c for c in chunks if not c.token_count]
+        if not missing:
+            return
+        encoded = self.tokenizer.encode_batch(
+            [c.content for c in missing], num_threads=settings.CHUNK_TOKENIZER_THREADS
+        )
+        for chunk, tokens in zip(missing, encoded):
+            chunk.token_count = len(tokens)
+
+    def _sep_tokens(self, sep: str) -> int:
+        """
+        分隔符的 token 数 (缓存)
+        拼接文本的 token 数按 各部分 + 分隔符 累加估算，避免对不断增长的字符串重复编码；
+        边界处的合并只会让实际值更小，估算值略偏大 (分块只会偏小，不会超限)
+        """
+        count = self._sep_token_cache.get(sep)
+        if count is None:
+            count = self._sep_token_cache[sep] = self.count_tokens(sep)
+        return count
+
     def chunk_document(
         self,
         parsed_doc: ParsedDocument,
@@ -61,29 +105,13 @@ class SmartChunker:
             logger.warning(f"Empty document: {file_name}")
             return []
 
-        # 策略路由
-        if chunk_method == "line":
-            chunks = self._chunk_by_line(content)
-        elif chunk_method == "paragraph":
-            chunks = self._chunk_by_paragraph(content)
-        elif chunk_method == "hierarchical":
-            chunks = self._chunk_hierarchical(content)
-        elif self._is_markdown_structured(content):
-            chunks = self._chunk_by_headers(content)
-        elif self._is_qa_format(content):
-            chunks = self._chunk_by_qa(content)
-        elif file_type in (".xlsx", ".csv"):
-            chunks = self._chunk_table(content)
-        else:
-            chunks = self._chunk_by_semantic_paragraph(content)
-
-        # 过滤太短的块
-        chunks = [c for c in chunks if len(c.content.strip()) >= self.min_chunk_size]
+        chunks = self._chunk_content(content, file_type, chunk_method)
+        self._fill_token_counts(chunks)
+        page_starts = [p["start"] for p in parsed_doc.pages]
 
         # 添加元数据
         for i, chunk in enumerate(chunks):
             chunk.chunk_index = i
-            chunk.token_count = self.count_tokens(chunk.content)
             chunk.metadata.update({
                 "doc_id": doc_id,
                 "kb_id": kb_id,
@@ -91,10 +119,10 @@ class SmartChunker:
                 "chunk_total": len(chunks),
             })
 
-            # 页码映射 (PDF)
+            # 页码映射 (PDF / PPTX)
             if parsed_doc.pages:
                 chunk.metadata["page"] = self._find_page(
-                    chunk.content, parsed_doc.pages
+                    chunk.metadata.get("start_offset"), page_starts, parsed_doc.pages
                 )
 
         logger.info(
@@ -102,6 +130,79 @@ class SmartChunker:
         )
         return chunks
 
+    def chunk_stream(
+        self,
+        streamed_doc: StreamedDocument,
+        doc_id: str,
+        kb_id: str,
+        chunk_method: str = "smart",
+    ) -> Iterator[Chunk]:
+        """
+        流式分块: 逐个消费解析片段并产出分块，内存中只保留当前片段
+        分块不跨片段 (页 / 幻灯片)，页码直接取自片段；总块数事先未知，不写 chunk_total
+        """
+        file_type = streamed_doc.metadata.get("file_type", "")
+        file_name = streamed_doc.metadata.get("file_name", "")
+
+        chunk_index = 0
+        base_offset = 0  # 当前片段在全文 (各片段以 PAGE_SEPARATOR 拼接) 中的起始偏移
+        for segment in streamed_doc.segments:
+            if not segment.content.strip():
+                continue
+            if segment.rows is not None and chunk_method == "smart":
+                # 表格片段: 数据行直接流入按行组分块，不拼接整张表
+                segment_chunks = self._chunk_table_rows(segment.content, segment.rows)
+            elif segment.rows is not None:
+                content = "\n".join([segment.content, *segment.rows])
+                segment_chunks = self._chunk_content(content, file_type, chunk_method)
+            else:
+                segment_chunks = self._chunk_content(segment.content, file_type, chunk_method)
+            if isinstance(segment_chunks, list):
+                self._fill_token_counts(segment_chunks)
+                if segment.rows is None:
+                    self._shift_offsets(segment_chunks, base_offset)
+                    base_offset += len(segment.content) + len(PAGE_SEPARATOR)
+
+            for chunk in segment_chunks:
+                if len(chunk.content.strip()) < self.min_chunk_size:
+                    continue
+                if not chunk.token_count:
+                    chunk.token_count = self.count_tokens(chunk.content)
+                chunk.chunk_index = chunk_index
+                chunk.metadata.update({
+                    "doc_id": doc_id,
+                    "kb_id": kb_id,
+                    "filename": file_name,
+                })
+                if segment.page is not None:
+                    chunk.metadata["page"] = segment.page
+                chunk_index += 1
+                yield chunk
+
+        logger.info(
+            f"Document '{file_name}' chunked into {chunk_index} chunks (stream)"
+        )
+
+    def _chunk_content(self, content: str, file_type: str, chunk_method: str) -> List[Chunk]:
+        """按分块方式 / 内容特征路由到具体分块策略，并过滤太短的块"""
+        if chunk_method == "line":
+            chunks = self._chunk_by_line(content)
+        elif chunk_method == "paragraph":
+            chunks = self._chunk_by_paragraph(content)
+        elif chunk_method == "hierarchical":
+            chunks = self._chunk_hierarchical(content)
+        elif self._is_markdown_structured(content):
+            chunks = self._chunk_by_headers(content)
+        elif self._is_qa_format(content):
+            chunks = self._chunk_by_qa(content)
+        elif file_type in (".xlsx", ".csv"):
+            chunks = self._chunk_table(content)
+        else:
+            chunks = self._chunk_by_semantic_paragraph(content)
+
+        # 过滤太短的块
+        return [c for c in chunks if len(c.content.strip()) >= self.min_chunk_size]
+
     # ───────── 策略 1: 按标题层级分块 (Markdown / 结构化文档) ─────────
     def _chunk_by_headers(self, content: str) -> List[Chunk]:
         """基于 Markdown 标题层级的分块"""
@@ -116,10 +217,11 @@ class SmartChunker:
             title = match.group(2).strip()
 
             if last_pos < match.start():
-                section_text = content[last_pos:match.start()].strip()
-                if section_text:
+                start, end = self._strip_span(content, last_pos, match.start())
+                if start < end:
                     sections.append({
-                        "content": section_text,
+                        "content": content[start:end],
+                        "start": start,
                         "headers": dict(current_headers),
                     })
 
@@ -131,10 +233,11 @@ class SmartChunker:
             last_pos = match.start()
 
         # 最后一段
-        remaining = content[last_pos:].strip()
-        if remaining:
+        start, end = self._strip_span(content, last_pos, len(content))
+        if start < end:
             sections.append({
-                "content": remaining,
+                "content": content[start:end],
+                "start": start,
                 "headers": dict(current_headers),
             })
 
@@ -142,17 +245,23 @@ class SmartChunker:
         chunks = []
         for section in sections:
             text = section["content"]
-            if self.count_tokens(text) > self.chunk_size:
-                sub_chunks = self._split_text_with_overlap(text)
-                for sc in sub_chunks:
+            text_tokens = self.count_tokens(text)
+            if text_tokens > self.chunk_size:
+                sub_chunks = self._split_with_token_counts(text, section["start"])
+                for sc, sc_tokens, sc_start, sc_end in sub_chunks:
                     chunks.append(Chunk(
                         content=sc,
-                        metadata={"headers": section["headers"]},
+                        token_count=sc_tokens,
+                        metadata={"headers": section["headers"], **self._span(sc_start, sc_end)},
                     ))
             else:
                 chunks.append(Chunk(
                     content=text,
-                    metadata={"headers": section["headers"]},
+                    token_count=text_tokens,
+                    metadata={
+                        "headers": section["headers"],
+                        **self._span(section["start"], section["start"] + len(text)),
+                    },
                 ))
 
         return chunks
@@ -162,32 +271,50 @@ class SmartChunker:
         """基于段落的语义分块，确保不在句子中间断开"""
         paragraphs = self._split_paragraphs(content)
         chunks = []
-        current_chunk = ""
-
-        for para in paragraphs:
-            para = para.strip()
-            if not para:
-                continue
-
-            test_chunk = (current_chunk + "\n\n" + para).strip() if current_chunk else para
-
-            if self.count_tokens(test_chunk) <= self.chunk_size:
-                current_chunk = test_chunk
+        # 每个段落只编码一次，当前块的 token 数按段落累加；块的原文范围为首段起点到末段终点
+        current_parts = []
+        current_tokens = 0
+        current_start = current_end = 0
+        sep_tokens = self._sep_tokens("\n\n")
+
+        for para, para_start, para_end in paragraphs:
+            para_tokens = self.count_tokens(para)
+            test_tokens = current_tokens + sep_tokens + para_tokens if current_parts else para_tokens
+
+            if test_tokens <= self.chunk_size:
+                if not current_parts:
+                    current_start = para_start
+                current_parts.append(para)
+                current_tokens = test_tokens
+                current_end = para_end
             else:
-                if current_chunk:
-                    chunks.append(Chunk(content=current_chunk))
+                if current_parts:
+                    chunks.append(Chunk(
+                        content="\n\n".join(current_parts),
+                        token_count=current_tokens,
+                        metadata=self._span(current_start, current_end),
+                    ))
 
                 # 如果单个段落就超长，需要进一步拆分
-                if self.count_tokens(para) > self.chunk_size:
-                    sub_chunks = self._split_text_with_overlap(para)
-                    for sc in sub_chunks:
-                        chunks.append(Chunk(content=sc))
-                    current_chunk = ""
+                if para_tokens > self.chunk_size:
+                    sub_chunks = self._split_with_token_counts(para, para_start)
+                    for sc, sc_tokens, sc_start, sc_end in sub_chunks:
+                        chunks.append(Chunk(
+                            content=sc, token_count=sc_tokens, metadata=self._span(sc_start, sc_end)
+                        ))
+                    current_parts = []
+                    current_tokens = 0
                 else:
-                    current_chunk = para
+                    current_parts = [para]
+                    current_tokens = para_tokens
+                    current_start, current_end = para_start, para_end
 
-        if current_chunk:
-            chunks.append(Chunk(content=current_chunk))
+        if current_parts:
+            chunks.append(Chunk(
+                content="\n\n".join(current_parts),
+                token_count=current_tokens,
+                metadata=self._span(current_start, current_end),
+            ))
 
         return chunks
 
@@ -198,15 +325,17 @@ class SmartChunker:
             r'(?:Q|问|问题)[：:\s]*(.+?)\n+(?:A|答|回答)[：:\s]*(.+?)(?=\n+(?:Q|问|问题)[：:\s]|\Z)',
             re.DOTALL | re.IGNORECASE,
         )
-        matches = qa_pattern.findall(content)
+        matches = list(qa_pattern.finditer(content))
 
         if not matches:
             return self._chunk_by_semantic_paragraph(content)
 
         chunks = []
-        for q, a in matches:
+        for match in matches:
+            q, a = match.groups()
             chunk_text = f"问：{q.strip()}\n答：{a.strip()}"
-            chunks.append(Chunk(content=chunk_text, metadata={"type": "qa"}))
+            start, end = self._strip_span(content, match.start(), match.end())
+            chunks.append(Chunk(content=chunk_text, metadata={"type": "qa", **self._span(start, end)}))
 
         return chunks
 
@@ -226,68 +355,139 @@ class SmartChunker:
             else:
                 data_lines.append(line)
 
-        header = "\n".join(header_lines)
-        chunks = []
+        return list(self._chunk_table_rows("\n".join(header_lines), data_lines))
+
+    def _chunk_table_rows(self, header: str, rows: Iterable[str]) -> Iterator[Chunk]:
+        """按行组分块，行可以是惰性生成的 (流式读取的大表格)，每个分块都带表头"""
+        # 表头和每行只编码一次，块大小按行累加
+        sep_tokens = self._sep_tokens("\n")
+        header_tokens = self.count_tokens(header)
         current_rows = []
+        current_tokens = header_tokens
 
-        for row in data_lines:
-            current_rows.append(row)
-            test_text = header + "\n" + "\n".join(current_rows)
-            if self.count_tokens(test_text) > self.chunk_size:
+        for row in rows:
+            row_tokens = sep_tokens + self.count_tokens(row)
+            if current_tokens + row_tokens > self.chunk_size:
                 # 保存当前块
-                if len(current_rows) > 1:
-                    chunk_text = header + "\n" + "\n".join(current_rows[:-1])
-                    chunks.append(Chunk(content=chunk_text, metadata={"type": "table"}))
+                if current_rows:
+                    chunk_text = header + "\n" + "\n".join(current_rows)
+                    yield Chunk(
+                        content=chunk_text, token_count=current_tokens, metadata={"type": "table"}
+                    )
                     current_rows = [row]
+                    current_tokens = header_tokens + row_tokens
                 else:
-                    chunks.append(Chunk(content=test_text, metadata={"type": "table"}))
-                    current_rows = []
+                    # 单行就超长，单独成块
+                    yield Chunk(
+                        content=header + "\n" + row,
+                        token_count=header_tokens + row_tokens,
+                        metadata={"type": "table"},
+                    )
+                continue
+
+            current_rows.append(row)
+            current_tokens += row_tokens
 
         if current_rows:
             chunk_text = header + "\n" + "\n".join(current_rows)
-            chunks.append(Chunk(content=chunk_text, metadata={"type": "table"}))
-
-        return chunks
+            yield Chunk(content=chunk_text, token_count=current_tokens, metadata={"type": "table"})
 
     # ───────── 辅助方法 ─────────
     def _split_text_with_overlap(self, text: str) -> List[str]:
         """按 token 数滑窗分割，保证有重叠"""
-        sentences = self._split_sentences(text)
+        return [piece for piece, *_ in self._split_with_token_counts(text)]
+
+    def _split_with_token_counts(self, text: str, base: int = 0) -> List[Tuple[str, int, int, int]]:
+        """
+        按 token 数滑窗分割，返回 [(文本, token 数, 起始偏移, 结束偏移)]
+        base 为 text 在原文中的起始偏移，块的原文范围为首句起点到末句终点
+        """
+        space_tokens = self._sep_tokens(" ")
+        sentences = self._split_sentences(text, base)
         chunks = []
+        # 每句只编码一次，窗口内各句的 token 数与窗口总数同步维护
         current = []
+        current_counts = []
         current_tokens = 0
 
-        for sent in sentences:
-            sent_tokens = self.count_tokens(sent)
+        def emit():
+            chunks.append((
+                " ".join(sent for sent, _, _ in current),
+                current_tokens + space_tokens * (len(current) - 1),
+                current[0][1],
+                current[-1][2],
+            ))
+
+        for sentence in sentences:
+            sent_tokens = self.count_tokens(sentence[0])
             if current_tokens + sent_tokens > self.chunk_size and current:
-                chunks.append(" ".join(current))
+                emit()
                 # 重叠: 保留最后几句
                 overlap_tokens = 0
                 overlap_start = len(current)
                 for j in range(len(current) - 1, -1, -1):
-                    overlap_tokens += self.count_tokens(current[j])
+                    overlap_tokens += current_counts[j]
                     if overlap_tokens >= self.chunk_overlap:
                         overlap_start = j
                         break
                 current = current[overlap_start:]
-                current_tokens = sum(self.count_tokens(s) for s in current)
+                current_counts = current_counts[overlap_start:]
+                current_tokens = sum(current_counts)
 
-            current.append(sent)
+            current.append(sentence)
+            current_counts.append(sent_tokens)
             current_tokens += sent_tokens
 
         if current:
-            chunks.append(" ".join(current))
+            emit()
 
         return chunks
 
-    def _split_paragraphs(self, text: str) -> List[str]:
-        """按段落分割"""
-        return re.split(r'\n\s*\n', text)
-
-    def _split_sentences(self, text: str) -> List[str]:
-        """按句子分割 (中英文兼容)"""
-        sentences = re.split(r'(?<=[。！？.!?])\s*', text)
-        return [s.strip() for s in sentences if s.strip()]
+    @staticmethod
+    def _span(start: int, end: int) -> dict:
+        """分块在原文中的字符偏移 [start, end)，用于页码映射和引用高亮"""
+        return {"start_offset": start, "end_offset": end}
+
+    @staticmethod
+    def _strip_span(text: str, start: int, end: int) -> Tuple[int, int]:
+        """text[start:end] 去掉首尾空白后的范围 (全为空白时 start == end)"""
+        piece = text[start:end]
+        stripped = piece.strip()
+        if not stripped:
+            return start, start
+        start += len(piece) - len(piece.lstrip())
+        return start, start + len(stripped)
+
+    def _split_spans(self, text: str, separator: re.Pattern, base: int = 0) -> List[Tuple[str, int, int]]:
+        """按分隔符切分并去掉首尾空白，返回 [(片段, 起始偏移, 结束偏移)]，跳过空片段"""
+        bounds = []
+        last = 0
+        for match in separator.finditer(text):
+            bounds.append((last, match.start()))
+            last = match.end()
+        bounds.append((last, len(text)))
+
+        spans = []
+        for start, end in bounds:
+            start, end = self._strip_span(text, start, end)
+            if start < end:
+                spans.append((text[start:end], base + start, base + end))
+        return spans
+
+    def _split_paragraphs(self, text: str, base: int = 0) -> List[Tuple[str, int, int]]:
+        """按段落分割，返回 [(段落, 起始偏移, 结束偏移)]"""
+        return self._split_spans(text, PARAGRAPH_SEPARATOR, base)
+
+    def _split_sentences(self, text: str, base: int = 0) -> List[Tuple[str, int, int]]:
+        """按句子分割 (中英文兼容)，返回 [(句子, 起始偏移, 结束偏移)]"""
+        return self._split_spans(text, SENTENCE_SEPARATOR, base)
+
+    def _shift_offsets(self, chunks: List[Chunk], base: int):
+        """片段内偏移加上片段在全文中的起始偏移"""
+        for chunk in chunks:
+            if "start_offset" in chunk.metadata:
+                chunk.metadata["start_offset"] += base
+                chunk.metadata["end_offset"] += base
 
     def _is_markdown_structured(self, content: str) -> bool:
         """检测是否有 Markdown 标题结构"""
@@ -301,43 +501,36 @@ class SmartChunker:
         )
         return len(qa_markers) >= 3
 
-    def _find_page(self, chunk_text: str, pages: List[dict]) -> Optional[int]:
-        """将 chunk 映射到 PDF 页码"""
-        chunk_start = chunk_text[:100]
-        for page in pages:
-            if chunk_start in page.get("content", ""):
-                return page["page"]
-        return None
+    def _find_page(
+        self, offset: Optional[int], page_starts: List[int], pages: List[dict]
+    ) -> Optional[int]:
+        """按分块起始偏移二分查找所在页"""
+        if offset is None:
+            return None
+        i = bisect.bisect_right(page_starts, offset) - 1
+        return pages[i]["page"] if i >= 0 else None
 
     # ───────── 策略 6: 按行分块 ─────────
     def _chunk_by_line(self, content: str) -> List[Chunk]:
         """按行分块，每行作为一个块"""
-        lines = content.strip().split('\n')
+        lines = self._split_spans(content, re.compile(r'\n'))
         chunks = []
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
+        for line, start, end in lines:
             # 每行作为一个单独的块
-            chunks.append(Chunk(content=line))
+            chunks.append(Chunk(content=line, metadata=self._span(start, end)))
         
         return chunks
 
     # ───────── 策略 7: 按段落分块 ─────────
     def _chunk_by_paragraph(self, content: str) -> List[Chunk]:
         """按段落分块，每个段落作为一个块"""
-        paragraphs = content.strip().split('\n\n')
+        paragraphs = self._split_spans(content, re.compile(r'\n\n'))
         chunks = []
         
-        for paragraph in paragraphs:
-            paragraph = paragraph.strip()
-            if not paragraph:
-                continue
-            
+        for paragraph, start, end in paragraphs:
             # 每个段落作为一个单独的块
-            chunks.append(Chunk(content=paragraph))
+            chunks.append(Chunk(content=paragraph, metadata=self._span(start, end)))
         
         return chunks
 
@@ -345,32 +538,26 @@ class SmartChunker:
     def _chunk_hierarchical(self, content: str) -> List[Chunk]:
         """父子分块策略，建立块之间的层次关系"""
         # 第一步：将文档按段落分成父块
-        paragraphs = content.strip().split('\n\n')
+        paragraphs = self._split_spans(content, re.compile(r'\n\n'))
         parent_chunks = []
         child_chunks = []
+        space_tokens = self._sep_tokens(" ")
         
-        for i, paragraph in enumerate(paragraphs):
-            paragraph = paragraph.strip()
-            if not paragraph:
-                continue
-            
+        for paragraph, para_start, para_end in paragraphs:
             # 创建父块
-            parent_chunk = Chunk(content=paragraph)
+            parent_chunk = Chunk(content=paragraph, metadata=self._span(para_start, para_end))
             parent_chunks.append(parent_chunk)
             
             # 第二步：将父块分成更小的子块
-            # 按句子或语义单位分割
-            sentences = self._split_sentences(paragraph)
+            # 按句子或语义单位分割 (句子偏移相对全文)
+            sentences = self._split_sentences(paragraph, para_start)
             current_child = []
             current_tokens = 0
             
             for sentence in sentences:
-                sentence = sentence.strip()
-                if not sentence:
-                    continue
-                
-                test_child = (" ".join(current_child) + " " + sentence).strip() if current_child else sentence
-                test_tokens = self.count_tokens(test_child)
+                # 每句只编码一次，子块 token 数按句累加
+                sentence_tokens = self.count_tokens(sentence[0])
+                test_tokens = current_tokens + space_tokens + sentence_tokens if current_child else sentence_tokens
                 
                 if test_tokens <= self.chunk_size // 2:  # 子块大小为父块的一半
                     current_child.append(sentence)
@@ -378,31 +565,26 @@ class SmartChunker:
                 else:
                     if current_child:
                         # 创建子块并关联到父块
-                        child_content = " ".join(current_child)
-                        child_chunk = Chunk(
-                            content=child_content,
-                            parent_id=parent_chunk.id
-                        )
-                        child_chunks.append(child_chunk)
+                        child_chunks.append(self._child_chunk(current_child, current_tokens, parent_chunk.id))
                         current_child = [sentence]
-                        current_tokens = self.count_tokens(sentence)
+                        current_tokens = sentence_tokens
                     else:
                         # 单个句子就超过子块大小，直接作为子块
-                        child_chunk = Chunk(
-                            content=sentence,
-                            parent_id=parent_chunk.id
-                        )
-                        child_chunks.append(child_chunk)
+                        child_chunks.append(self._child_chunk([sentence], sentence_tokens, parent_chunk.id))
             
             # 处理最后一个子块
             if current_child:
-                child_content = " ".join(current_child)
-                child_chunk = Chunk(
-                    content=child_content,
-                    parent_id=parent_chunk.id
-                )
-                child_chunks.append(child_chunk)
+                child_chunks.append(self._child_chunk(current_child, current_tokens, parent_chunk.id))
         
         # 合并父块和子块
         all_chunks = parent_chunks + child_chunks
-        return all_chunks
\ No newline at end of file
+        return all_chunks
+
+    def _child_chunk(self, sentences: List[Tuple[str, int, int]], token_count: int, parent_id: str) -> Chunk:
+        """由连续句子组成子块，原文范围为首句起点到末句终点"""
+        return Chunk(
+            content=" ".join(sentence for sentence, _, _ in sentences),
+            token_count=token_count,
+            parent_id=parent_id,
+            metadata=self._span(sentences[0][1], sentences[-1][2]),
+        )
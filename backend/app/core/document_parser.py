@@ -3,21 +3,117 @@ SmartRAG 智能文档解析引擎
 支持: PDF, DOCX, TXT, Markdown, PPTX, XLSX, HTML
 """
 import os
-from typing import List, Optional
+import codecs
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Iterator, Tuple
 from dataclasses import dataclass, field
 from loguru import logger
 
+from backend.app.config import get_settings
+
+settings = get_settings()
+
+# 分页文本在全文中的分隔符 (流式解析的片段偏移也按它累计)
+PAGE_SEPARATOR = "\n\n"
+
 
 @dataclass
 class ParsedDocument:
     """解析后的文档对象"""
     content: str
     pages: List[dict] = field(default_factory=list)
-    # pages: [{"page": 1, "content": "...", "tables": [...]}]
+    # pages: [{"page": 1, "start": 0, "end": 1024}]  页在 content 中的字符偏移 [start, end)，按 start 升序
     metadata: dict = field(default_factory=dict)
     tables: List[dict] = field(default_factory=list)
 
 
+@dataclass
+class DocumentSegment:
+    """
+    流式解析产出的文档片段 (一页 / 一张幻灯片 / 一个工作表 / 整篇文档)
+    表格片段: content 为表头 (每个分块都会带上)，rows 为惰性生成的数据行
+    """
+    content: str
+    page: Optional[int] = None
+    rows: Optional[Iterator[str]] = None
+
+
+@dataclass
+class StreamedDocument:
+    """流式解析结果: 元数据立即可用，片段按需惰性生成"""
+    segments: Iterator[DocumentSegment]
+    metadata: dict = field(default_factory=dict)
+
+
+def _extract_pdf_pages(
+    file_path: str, start: int, end: int, extract_tables: bool = True
+) -> List[dict]:
+    """
+    解析 PDF 的 [start, end) 页 (模块级函数，可在子进程中执行)
+    返回: [{"page": 1, "content": "...", "tables": [[row, ...], ...]}]
+    """
+    import pdfplumber
+
+    results = []
+    with pdfplumber.open(file_path, pages=list(range(start + 1, end + 1))) as pdf:
+        for page in pdf.pages:
+            text = (page.extract_text() or "").strip()
+            tables = []
+            # 表格识别基于表格线，没有线条 / 矩形的页直接跳过
+            if extract_tables and (page.lines or page.rects):
+                try:
+                    tables = [t for t in page.extract_tables() if t]
+                except Exception as e:
+                    logger.warning(f"Table extraction failed on page {page.page_number}: {e}")
+            results.append({
+                "page": page.page_number,
+                "content": text,
+                "tables": tables,
+            })
+            # 释放页面对象缓存，控制内存
+            page.close()
+    return results
+
+
+# 大 PDF 按页区间并行解析的进程池 (模块级共享，spawn 启动，避免 fork 多线程的 API 进程)
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+# 解析子进程内关闭页级并行，避免嵌套进程池 (孙进程不受子进程超时 / 内存上限约束)
+_page_parallel = True
+
+
+def disable_page_parallelism():
+    """在解析子进程中调用，PDF 改为在当前进程内顺序解析"""
+    global _page_parallel
+    _page_parallel = False
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=settings.PDF_PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pdf_pool
+
+
+def shutdown_pdf_pool(pool: Optional[ProcessPoolExecutor] = None):
+    """关闭 PDF 页解析进程池 (指定 pool 时只在它仍是当前进程池时关闭)"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if pool is not None and pool is not _pdf_pool:
+            return
+        pool, _pdf_pool = _pdf_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
 class DocumentParser:
     """多格式文档解析器"""
 
@@ -26,6 +122,10 @@ class DocumentParser:
         ".pptx", ".xlsx", ".csv", ".html", ".htm",
     }
 
+    CSV_ENCODING_SAMPLE_SIZE = 64 * 1024  # 编码检测先只读取文件开头的样本
+    # GB2312 / GBK 是 GB18030 的子集，检测结果统一按 GB18030 解码，避免生僻字解码失败
+    ENCODING_ALIASES = {"gb2312": "gb18030", "gbk": "gb18030"}
+
     def parse(self, file_path: str) -> ParsedDocument:
         """主解析入口 - 根据文件类型路由到对应解析器"""
         ext = os.path.splitext(file_path)[1].lower()
@@ -57,74 +157,197 @@ class DocumentParser:
         result.metadata["file_name"] = os.path.basename(file_path)
         return result
 
+    def parse_stream(self, file_path: str) -> StreamedDocument:
+        """
+        流式解析入口 - 按页 / 幻灯片惰性产出片段，不在内存中保留整篇文档
+        不支持分页的格式整篇作为一个片段
+        """
+        ext = os.path.splitext(file_path)[1].lower()
+        logger.info(f"Parsing document (stream): {file_path} (type={ext})")
+
+        if ext not in self.SUPPORTED_TYPES:
+            raise ValueError(f"不支持的文件类型: {ext}")
+
+        metadata = {
+            "file_type": ext,
+            "file_path": file_path,
+            "file_name": os.path.basename(file_path),
+        }
+        if ext == ".pdf":
+            segments = self._stream_pdf(file_path, metadata)
+        elif ext == ".pptx":
+            segments = self._stream_pptx(file_path, metadata)
+        elif ext == ".xlsx":
+            segments = self._stream_excel(file_path, metadata)
+        elif ext == ".csv":
+            segments = self._stream_csv(file_path, metadata)
+        else:
+            segments = self._stream_whole(file_path)
+        return StreamedDocument(segments=segments, metadata=metadata)
+
+    def _stream_whole(self, file_path: str) -> Iterator[DocumentSegment]:
+        """不分页的格式: 整篇作为一个片段"""
+        parsed = self.parse(file_path)
+        if parsed.content.strip():
+            yield DocumentSegment(content=parsed.content)
+
     # ───────── PDF 解析 ─────────
+    def _iter_pdf_pages(
+        self, file_path: str, total_pages: int, extract_tables: bool = True
+    ) -> Iterator[dict]:
+        """
+        单遍解析: 每页在同一次遍历中提取文本和表格 (只对存在表格线的页做表格识别)
+        按 PDF_STREAM_BATCH_PAGES 页为一批，页数较多时多个批次在共享进程池中并行解析，
+        在途批次数不超过进程数，结果按页序产出 (解析子进程内顺序解析)
+        """
+        batch = max(1, settings.PDF_STREAM_BATCH_PAGES)
+        ranges = [(s, min(s + batch, total_pages)) for s in range(0, total_pages, batch)]
+
+        workers = min(settings.PDF_PARSE_WORKERS, len(ranges))
+        if not _page_parallel or workers <= 1 or total_pages < settings.PDF_PARALLEL_MIN_PAGES:
+            for start, end in ranges:
+                yield from _extract_pdf_pages(file_path, start, end, extract_tables)
+            return
+
+        executor = _get_pdf_pool()
+        pending = deque()
+        try:
+            remaining = iter(ranges)
+            for start, end in remaining:
+                pending.append(
+                    executor.submit(_extract_pdf_pages, file_path, start, end, extract_tables)
+                )
+                if len(pending) >= workers:
+                    break
+            while pending:
+                future = pending.popleft()
+                next_range = next(remaining, None)
+                if next_range is not None:
+                    pending.append(
+                        executor.submit(_extract_pdf_pages, file_path, *next_range, extract_tables)
+                    )
+                yield from future.result()
+        except BrokenProcessPool:
+            # 子进程异常退出后进程池不可再用，下次使用时重建
+            shutdown_pdf_pool(executor)
+            raise
+        finally:
+            # 调用方提前停止 (失败 / 关闭生成器) 时取消尚未开始的批次
+            for future in pending:
+                future.cancel()
+
+    def _pdf_page_count(self, file_path: str) -> Optional[int]:
+        try:
+            import pdfplumber
+        except ImportError:
+            logger.warning("pdfplumber not installed, falling back to pypdf (no table extraction)")
+            return None
+        with pdfplumber.open(file_path) as pdf:
+            return len(pdf.pages)
+
+    def _stream_pdf(self, file_path: str, metadata: dict) -> Iterator[DocumentSegment]:
+        total_pages = self._pdf_page_count(file_path)
+        if total_pages is None:
+            from pypdf import PdfReader
+
+            reader = PdfReader(file_path)
+            metadata["total_pages"] = len(reader.pages)
+            for i, page in enumerate(reader.pages):
+                text = (page.extract_text() or "").strip()
+                if text:
+                    yield DocumentSegment(content=text, page=i + 1)
+            return
+
+        metadata["total_pages"] = total_pages
+        # 片段只携带正文 (与 parse 的 content 一致)，跳过表格识别
+        for page in self._iter_pdf_pages(file_path, total_pages, extract_tables=False):
+            if page["content"]:
+                yield DocumentSegment(content=page["content"], page=page["page"])
+
     def _parse_pdf(self, file_path: str) -> ParsedDocument:
+        total_pages = self._pdf_page_count(file_path)
+        if total_pages is None:
+            return self._parse_pdf_text_only(file_path)
+        page_results = self._iter_pdf_pages(file_path, total_pages)
+
+        blocks = []
+        tables = []
+        for page in page_results:
+            if page["content"]:
+                blocks.append((page["page"], page["content"]))
+            for t_idx, table in enumerate(page["tables"]):
+                # 将表格转为文本描述
+                header = table[0]
+                rows = table[1:]
+                tables.append({
+                    "page": page["page"],
+                    "table_index": t_idx,
+                    "content": self._table_to_text(header, rows),
+                    "raw": table,
+                })
+
+        content, pages = self._join_pages(blocks)
+        return ParsedDocument(
+            content=content,
+            pages=pages,
+            tables=tables,
+            metadata={
+                "total_pages": total_pages,
+            },
+        )
+
+    def _parse_pdf_text_only(self, file_path: str) -> ParsedDocument:
+        """仅提取文本 (pdfplumber 不可用时)"""
         from pypdf import PdfReader
 
         reader = PdfReader(file_path)
-        pages = []
-        full_text_parts = []
+        blocks = []
 
         for i, page in enumerate(reader.pages):
             text = page.extract_text() or ""
             text = text.strip()
             if text:
-                pages.append({
-                    "page": i + 1,
-                    "content": text,
-                })
-                full_text_parts.append(text)
-
-        # 尝试提取表格(使用简单方式，生产环境推荐 camelot / tabula)
-        tables = self._extract_pdf_tables(file_path)
+                blocks.append((i + 1, text))
 
+        content, pages = self._join_pages(blocks)
         return ParsedDocument(
-            content="\n\n".join(full_text_parts),
+            content=content,
             pages=pages,
-            tables=tables,
             metadata={
                 "total_pages": len(reader.pages),
             },
         )
 
-    def _extract_pdf_tables(self, file_path: str) -> List[dict]:
-        """PDF 表格提取 (简化版)"""
-        tables = []
-        try:
-            # 生产环境建议使用 camelot-py 或 pdfplumber
-            import pdfplumber
-            with pdfplumber.open(file_path) as pdf:
-                for i, page in enumerate(pdf.pages):
-                    page_tables = page.extract_tables()
-                    for t_idx, table in enumerate(page_tables):
-                        if table:
-                            # 将表格转为文本描述
-                            header = table[0] if table else []
-                            rows = table[1:] if len(table) > 1 else []
-                            table_text = self._table_to_text(header, rows)
-                            tables.append({
-                                "page": i + 1,
-                                "table_index": t_idx,
-                                "content": table_text,
-                                "raw": table,
-                            })
-        except ImportError:
-            logger.warning("pdfplumber not installed, skipping table extraction")
-        except Exception as e:
-            logger.warning(f"Table extraction failed: {e}")
-        return tables
+    def _join_pages(self, blocks: List[Tuple[int, str]]) -> Tuple[str, List[dict]]:
+        """以空行拼接分页文本，同时记录每页在全文中的字符偏移 [start, end)"""
+        pages = []
+        offset = 0
+        for page_no, text in blocks:
+            if pages:
+                offset += len(PAGE_SEPARATOR)
+            pages.append({"page": page_no, "start": offset, "end": offset + len(text)})
+            offset += len(text)
+        return PAGE_SEPARATOR.join(text for _, text in blocks), pages
 
     def _table_to_text(self, header: list, rows: list) -> str:
         """表格转自然语言描述"""
-        lines = []
-        header_clean = [str(h or "").strip() for h in header]
-        lines.append("| " + " | ".join(header_clean) + " |")
-        lines.append("| " + " | ".join(["---"] * len(header_clean)) + " |")
+        lines = [self._table_header(header)]
         for row in rows:
-            row_clean = [str(c or "").strip() for c in row]
-            lines.append("| " + " | ".join(row_clean) + " |")
+            lines.append(self._table_row(row))
         return "\n".join(lines)
 
+    def _table_header(self, header: list) -> str:
+        """表头 + 分隔行 (Markdown)"""
+        header_clean = [str(h or "").strip() for h in header]
+        return (
+            "| " + " | ".join(header_clean) + " |\n"
+            + "| " + " | ".join(["---"] * len(header_clean)) + " |"
+        )
+
+    def _table_row(self, row: list) -> str:
+        row_clean = [str(c or "").strip() for c in row]
+        return "| " + " | ".join(row_clean) + " |"
+
     # ───────── DOCX 解析 ─────────
     def _parse_docx(self, file_path: str) -> ParsedDocument:
         from docx import Document as DocxDocument
@@ -183,46 +406,76 @@ class DocumentParser:
         from pptx import Presentation
 
         prs = Presentation(file_path)
-        pages = []
-        all_text = []
+        blocks = []
 
         for i, slide in enumerate(prs.slides):
-            slide_texts = []
-            for shape in slide.shapes:
-                if shape.has_text_frame:
-                    for paragraph in shape.text_frame.paragraphs:
-                        text = paragraph.text.strip()
-                        if text:
-                            slide_texts.append(text)
-            slide_content = "\n".join(slide_texts)
+            slide_content = self._slide_text(slide)
             if slide_content:
-                pages.append({"page": i + 1, "content": slide_content})
-                all_text.append(f"[Slide {i + 1}]\n{slide_content}")
+                blocks.append((i + 1, f"[Slide {i + 1}]\n{slide_content}"))
 
+        content, pages = self._join_pages(blocks)
         return ParsedDocument(
-            content="\n\n".join(all_text),
+            content=content,
             pages=pages,
             metadata={"slide_count": len(prs.slides)},
         )
 
+    def _stream_pptx(self, file_path: str, metadata: dict) -> Iterator[DocumentSegment]:
+        from pptx import Presentation
+
+        prs = Presentation(file_path)
+        metadata["slide_count"] = len(prs.slides)
+        for i, slide in enumerate(prs.slides):
+            slide_content = self._slide_text(slide)
+            if slide_content:
+                yield DocumentSegment(content=f"[Slide {i + 1}]\n{slide_content}", page=i + 1)
+
+    def _slide_text(self, slide) -> str:
+        slide_texts = []
+        for shape in slide.shapes:
+            if shape.has_text_frame:
+                for paragraph in shape.text_frame.paragraphs:
+                    text = paragraph.text.strip()
+                    if text:
+                        slide_texts.append(text)
+        return "\n".join(slide_texts)
+
     # ───────── Excel 解析 ─────────
-    def _parse_excel(self, file_path: str) -> ParsedDocument:
+    def _iter_excel_sheets(
+        self, file_path: str, metadata: dict
+    ) -> Iterator[Tuple[str, str, Iterator[str]]]:
+        """
+        只读模式逐行读取工作表，不把整张表载入内存
+        产出: (工作表名, 表头文本, 惰性生成的数据行文本)
+        数据行需要在取下一个工作表之前消费完
+        """
         from openpyxl import load_workbook
 
-        wb = load_workbook(file_path, data_only=True)
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            metadata["sheet_count"] = len(wb.sheetnames)
+            for sheet_name in wb.sheetnames:
+                rows = wb[sheet_name].iter_rows(values_only=True)
+                first = next(rows, None)
+                if first is None:
+                    continue
+                header = [str(c or "") for c in first]
+                data_rows = (self._table_row([str(c or "") for c in r]) for r in rows)
+                yield sheet_name, self._table_header(header), data_rows
+        finally:
+            wb.close()
+
+    def _stream_excel(self, file_path: str, metadata: dict) -> Iterator[DocumentSegment]:
+        for sheet_name, header, rows in self._iter_excel_sheets(file_path, metadata):
+            yield DocumentSegment(content=f"[Sheet: {sheet_name}]\n{header}", rows=rows)
+
+    def _parse_excel(self, file_path: str) -> ParsedDocument:
+        metadata = {}
         all_text = []
         tables = []
 
-        for sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            rows = list(ws.iter_rows(values_only=True))
-            if not rows:
-                continue
-
-            header = [str(c or "") for c in rows[0]]
-            data_rows = [[str(c or "") for c in r] for r in rows[1:]]
-            table_text = self._table_to_text(header, data_rows)
-
+        for sheet_name, header, rows in self._iter_excel_sheets(file_path, metadata):
+            table_text = "\n".join([header, *rows])
             tables.append({
                 "sheet": sheet_name,
                 "content": table_text,
@@ -232,28 +485,82 @@ class DocumentParser:
         return ParsedDocument(
             content="\n\n".join(all_text),
             tables=tables,
-            metadata={"sheet_count": len(wb.sheetnames)},
+            metadata=metadata,
         )
 
     # ───────── CSV 解析 ─────────
-    def _parse_csv(self, file_path: str) -> ParsedDocument:
-        import csv
+    def _normalize_encoding(self, encoding: Optional[str]) -> str:
+        encoding = (encoding or "utf-8").lower()
+        # 纯 ASCII 样本可能是 UTF-8 文件的开头部分
+        if encoding == "ascii":
+            return "utf-8"
+        return self.ENCODING_ALIASES.get(encoding, encoding)
+
+    def _can_decode(self, file_path: str, encoding: str) -> bool:
+        """按块严格解码整个文件，检查编码是否正确 (内存只与块大小相关)"""
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
+            with open(file_path, "rb") as f:
+                while block := f.read(self.CSV_ENCODING_SAMPLE_SIZE):
+                    decoder.decode(block)
+            decoder.decode(b"", final=True)
+        except (UnicodeDecodeError, LookupError):
+            return False
+        return True
+
+    def _detect_encoding(self, file_path: str) -> Tuple[str, str]:
+        """
+        检测文件编码，返回 (编码, 解码错误处理方式)
+        开头样本的检测结果可能不适用于整个文件 (如前 64KB 为纯 ASCII)，
+        依次用检测结果、UTF-8、GB18030 严格解码整个文件，都失败时按 UTF-8 解码并替换无法识别的字符
+        """
         import chardet
 
         with open(file_path, "rb") as f:
-            raw = f.read()
-        encoding = chardet.detect(raw)["encoding"] or "utf-8"
+            sample = f.read(self.CSV_ENCODING_SAMPLE_SIZE)
+        detected = self._normalize_encoding(chardet.detect(sample)["encoding"])
+        for encoding in dict.fromkeys([detected, "utf-8", "gb18030"]):
+            if self._can_decode(file_path, encoding):
+                return encoding, "strict"
+
+        logger.warning(
+            f"Cannot decode {os.path.basename(file_path)} as {detected}, "
+            f"falling back to utf-8 with replacement characters"
+        )
+        return "utf-8", "replace"
+
+    def _iter_csv(self, file_path: str) -> Optional[Tuple[str, Iterator[str]]]:
+        """增量读取 CSV，返回 (表头文本, 惰性生成的数据行文本)；空文件返回 None"""
+        import csv
+
+        encoding, errors = self._detect_encoding(file_path)
+        f = open(file_path, "r", encoding=encoding, errors=errors, newline="")
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            f.close()
+            return None
+
+        def rows() -> Iterator[str]:
+            with f:
+                for row in reader:
+                    yield self._table_row(row)
 
-        lines = raw.decode(encoding).splitlines()
-        reader = csv.reader(lines)
-        rows = list(reader)
+        return self._table_header(header), rows()
 
-        if not rows:
+    def _stream_csv(self, file_path: str, metadata: dict) -> Iterator[DocumentSegment]:
+        table = self._iter_csv(file_path)
+        if table is not None:
+            header, rows = table
+            yield DocumentSegment(content=header, rows=rows)
+
+    def _parse_csv(self, file_path: str) -> ParsedDocument:
+        table = self._iter_csv(file_path)
+        if table is None:
             return ParsedDocument(content="")
 
-        header = rows[0]
-        data_rows = rows[1:]
-        table_text = self._table_to_text(header, data_rows)
+        header, rows = table
+        table_text = "\n".join([header, *rows])
 
         return ParsedDocument(
             content=table_text,
@@ -1,32 +1,148 @@
 """
 SmartRAG Embedding 服务
 支持: OpenAI API / 本地 Sentence-Transformers
+查询向量缓存: 进程内 LRU + TTL，可选 Redis 二级缓存
 """
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
 import numpy as np
-from typing import List
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 from loguru import logger
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, APIStatusError, APIConnectionError, APITimeoutError
 import httpx
 from backend.app.config import get_settings
 settings = get_settings()
 
 
-class EmbeddingService:
-    """向量化服务 - 单例模式"""
+class QueryEmbeddingCache:
+    """查询向量缓存 - key 为 (模型, 归一化文本)"""
 
-    _instance = None
+    def __init__(self, max_size: int = 10000, ttl: int = 3600, redis_url: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Tuple[str, str], Tuple[float, List[float]]]" = OrderedDict()
+        self._redis = None
+        if redis_url:
+            try:
+                import redis.asyncio as aioredis
+                self._redis = aioredis.from_url(redis_url)
+            except Exception as e:
+                logger.warning(f"Redis embedding cache disabled: {e}")
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
 
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
-        return cls._instance
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r"\s+", " ", text.strip())
 
-    def __init__(self,api_key=None,base_url=None,model_name=None, embedding_model=None):
-        if self._initialized:
+    @staticmethod
+    def _redis_key(key: Tuple[str, str]) -> str:
+        digest = hashlib.sha256(f"{key[0]}\x00{key[1]}".encode("utf-8")).hexdigest()
+        return f"smartrag:qemb:{digest}"
+
+    async def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = (model, self.normalize(text))
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, embedding = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return embedding
+            del self._data[key]
+
+        if self._redis is not None:
+            try:
+                raw = await self._redis.get(self._redis_key(key))
+                if raw:
+                    embedding = json.loads(raw)
+                    self._put_local(key, embedding)
+                    self.redis_hits += 1
+                    return embedding
+            except Exception as e:
+                logger.warning(f"Redis embedding cache get failed: {e}")
+
+        self.misses += 1
+        return None
+
+    async def set(self, model: str, text: str, embedding: List[float]):
+        key = (model, self.normalize(text))
+        self._put_local(key, embedding)
+        if self._redis is not None:
+            try:
+                await self._redis.set(self._redis_key(key), json.dumps(embedding), ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Redis embedding cache set failed: {e}")
+
+    def _put_local(self, key: Tuple[str, str], embedding: List[float]):
+        self._data[key] = (time.monotonic() + self.ttl, embedding)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.redis_hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.redis_hits) / total, 4) if total else 0.0,
+        }
+
+
+class AsyncRateLimiter:
+    """按提供方限速 - 保证相邻请求的最小间隔 (requests per second)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
             return
-        self._initialized = False
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
 
+
+_rate_limiters = {}
+
+
+def get_rate_limiter(provider: str) -> AsyncRateLimiter:
+    """获取提供方 (base_url) 对应的限速器，未单独配置时使用默认速率"""
+    limiter = _rate_limiters.get(provider)
+    if limiter is None:
+        rate = settings.EMBEDDING_RATE_LIMITS.get(provider, settings.EMBEDDING_DEFAULT_RATE_LIMIT)
+        limiter = AsyncRateLimiter(rate)
+        _rate_limiters[provider] = limiter
+    return limiter
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    max_size=settings.QUERY_EMBEDDING_CACHE_SIZE,
+    ttl=settings.QUERY_EMBEDDING_CACHE_TTL,
+    redis_url=settings.REDIS_URL if settings.QUERY_EMBEDDING_CACHE_REDIS else None,
+)
+
+
+class EmbeddingService:
+    """向量化服务 - 每个 Embedding 模型一个实例，通过 get_embedding_service 获取"""
+
+    def __init__(self,api_key=None,base_url=None,model_name=None, embedding_model=None):
+        # 在途请求数 / 是否已被注册表淘汰 (淘汰后空闲时关闭客户端)
+        self._in_flight = 0
+        self._retired = False
         # 检查是否有有效的API密钥
         has_valid_api_key = False
         if embedding_model and embedding_model.api_key:
@@ -48,17 +164,25 @@ class EmbeddingService:
         """初始化 OpenAI Embedding 客户端"""
         # from openai import AsyncOpenAI
         logger.info(f"_init_openai_client")
-        # 创建自定义的httpx AsyncClient，避免传递proxies参数
-        http_client = httpx.AsyncClient(
+        self._client_args = (api_key, base_url, model_name)
+        # 创建自定义的httpx AsyncClient，避免传递proxies参数；同一模型的请求共用该连接池
+        self.http_client = httpx.AsyncClient(
             timeout=httpx.Timeout(120.0),
-            follow_redirects=True
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=settings.EMBEDDING_MAX_CONCURRENCY * 2,
+                max_keepalive_connections=settings.EMBEDDING_MAX_CONCURRENCY,
+            ),
         )
         # 只传递必要的参数
+        # 重试由 _create_embeddings 统一处理 (含退避)，关闭 SDK 内置重试
         self.client = AsyncOpenAI(
             api_key=api_key,
             base_url=base_url,
-            http_client=http_client
+            http_client=self.http_client,
+            max_retries=0,
         )
+        self.base_url = base_url or ""
         self.model = model_name
         self.is_local = False
         logger.info(f"Embedding service initialized (AsyncOpenAI: {self.model})")
@@ -85,32 +209,103 @@ class EmbeddingService:
         else:
             return await self._embed_openai(texts)
 
+    @property
+    def model_key(self) -> str:
+        """
+        缓存 key 中使用的模型标识 (查询向量缓存 / Embedding 持久化存储共用)
+        包含提供方地址：不同提供方的同名模型向量维度 / 空间可能不同，不能互相复用
+        """
+        if self.is_local:
+            return settings.LOCAL_EMBEDDING_MODEL
+        return f"{self.base_url.rstrip('/')}|{self.model}"
+
     async def embed_query(self, query: str) -> List[float]:
-        """查询向量化"""
+        """查询向量化 (带缓存)"""
+        cached = await query_embedding_cache.get(self.model_key, query)
+        if cached is not None:
+            return cached
+
         result = await self.embed_texts([query])
-        return result[0] if result else []
+        embedding = result[0] if result else []
+        if embedding:
+            await query_embedding_cache.set(self.model_key, query, embedding)
+        return embedding
+
+    def cache_stats(self) -> dict:
+        """查询向量缓存命中统计"""
+        return query_embedding_cache.stats()
+
+    def retire(self):
+        """从注册表淘汰: 没有在途请求时立即关闭客户端，否则由最后一个在途请求结束时关闭"""
+        self._retired = True
+        if not self.is_local and not self._in_flight:
+            self._close_client()
+
+    def _close_client(self):
+        client, self.client = self.client, None
+        if client is not None:
+            close_client_later(client)
 
     async def _embed_openai(self, texts: List[str]) -> List[List[float]]:
-        """使用 OpenAI API"""
+        """使用 OpenAI API (多批并发、按提供方限速、失败退避重试，结果保持输入顺序)"""
         logger.info(f"_embed_openai开始")
-        all_embeddings = []
+        if self.client is None:
+            # 已淘汰的实例仍被旧引用 (如 VectorStore) 使用: 按原配置重建客户端，空闲后再次关闭
+            self._init_openai_client(*self._client_args)
         batch_size = 25  # API 限制批量大小不能超过 25
         max_length = 2048  # API 限制输入长度不能超过 2048 个 token
 
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i: i + batch_size]
-            # 限制每个文本的长度
-            batch = [text[:max_length] for text in batch]
-            response = await self.client.embeddings.create(
-                model=self.model,
-                input=batch,
-            )
-            embeddings = [item.embedding for item in response.data]
+        batches = [
+            [text[:max_length] for text in texts[i: i + batch_size]]
+            for i in range(0, len(texts), batch_size)
+        ]
+        semaphore = asyncio.Semaphore(max(1, settings.EMBEDDING_MAX_CONCURRENCY))
+        limiter = get_rate_limiter(self.base_url)
+
+        async def run_batch(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await self._create_embeddings(batch, limiter)
+
+        self._in_flight += 1
+        try:
+            results = await asyncio.gather(*[run_batch(batch) for batch in batches])
+        finally:
+            self._in_flight -= 1
+            if self._retired and not self._in_flight:
+                self._close_client()
+
+        all_embeddings = []
+        for embeddings in results:
             all_embeddings.extend(embeddings)
 
         logger.info(f"_embed_openai完成")
         return all_embeddings
 
+    async def _create_embeddings(self, batch: List[str], limiter: AsyncRateLimiter) -> List[List[float]]:
+        """单批 Embedding 请求，429 / 5xx / 网络错误时指数退避重试"""
+        max_retries = settings.EMBEDDING_MAX_RETRIES
+        for attempt in range(max_retries + 1):
+            await limiter.acquire()
+            try:
+                response = await self.client.embeddings.create(
+                    model=self.model,
+                    input=batch,
+                )
+                # 按 index 排序，保证与输入顺序一致
+                data = sorted(response.data, key=lambda item: item.index)
+                return [item.embedding for item in data]
+            except (APIStatusError, APIConnectionError, APITimeoutError) as e:
+                status = getattr(e, "status_code", None)
+                retryable = status is None or status == 429 or status >= 500
+                if not retryable or attempt >= max_retries:
+                    raise
+                delay = (2 ** attempt) * 0.5
+                delay = min(settings.EMBEDDING_RETRY_MAX_DELAY, delay + random.uniform(0, delay / 2))
+                logger.warning(
+                    f"Embedding request failed (status={status}), retry {attempt + 1}/{max_retries} in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+
     def _embed_local(self, texts: List[str]) -> List[List[float]]:
         """使用本地模型"""
         embeddings = self.local_model.encode(
@@ -118,4 +313,63 @@ class EmbeddingService:
             normalize_embeddings=True,
             show_progress_bar=False,
         )
-        return embeddings.tolist()
\ No newline at end of file
+        return embeddings.tolist()
+
+
+# ───────── 按模型复用的 EmbeddingService 注册表 ─────────
+_closing_tasks = set()
+
+
+async def _close_after(client, delay: float = 0):
+    if delay > 0:
+        await asyncio.sleep(delay)
+    try:
+        await client.close()
+    except Exception as e:
+        logger.warning(f"Failed to close evicted client: {e}")
+
+
+def close_client_later(client, delay: float = 0):
+    """
+    关闭被淘汰的 AsyncOpenAI 客户端 (释放其 httpx 连接池)
+    注册表是同步接口，在事件循环中时异步关闭；没有运行中的事件循环时 (不会有在途请求) 直接同步关闭
+    delay: 延迟关闭的秒数，留给仍持有该客户端的在途请求完成
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(_close_after(client))
+        return
+    task = loop.create_task(_close_after(client, delay))
+    # 保留引用，避免任务在完成前被回收
+    _closing_tasks.add(task)
+    task.add_done_callback(_closing_tasks.discard)
+
+
+_services: "OrderedDict[tuple, EmbeddingService]" = OrderedDict()
+
+
+def embedding_service_key(api_key=None, base_url=None, model_name=None, embedding_model=None) -> tuple:
+    """注册表 key: 模型 ID + 连接配置 (模型配置修改后自动使用新实例)"""
+    if settings.USE_LOCAL_EMBEDDING or not ((embedding_model and embedding_model.api_key) or api_key):
+        return ("local", settings.LOCAL_EMBEDDING_MODEL)
+    if embedding_model:
+        return (embedding_model.id, embedding_model.base_url, embedding_model.model, embedding_model.api_key)
+    return (None, base_url, model_name, api_key)
+
+
+def get_embedding_service(api_key=None, base_url=None, model_name=None, embedding_model=None) -> EmbeddingService:
+    """按模型获取 (惰性创建) EmbeddingService，超出容量时淘汰最久未使用的实例"""
+    key = embedding_service_key(api_key, base_url, model_name, embedding_model)
+    service = _services.get(key)
+    if service is not None:
+        _services.move_to_end(key)
+        return service
+
+    service = EmbeddingService(api_key, base_url, model_name, embedding_model)
+    _services[key] = service
+    while len(_services) > settings.EMBEDDING_SERVICE_CACHE_SIZE:
+        _, evicted = _services.popitem(last=False)
+        logger.info(f"Embedding service evicted: {getattr(evicted, 'model', 'local')}")
+        evicted.retire()
+    return service
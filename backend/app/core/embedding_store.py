@@ -0,0 +1,89 @@
+"""
+SmartRAG Embedding 持久化存储
+- key: (embedding 模型标识, 分块文本 sha256)
+- 跨文档 / 跨知识库复用相同文本的向量，避免重复调用 Embedding API
+"""
+import os
+import hashlib
+import sqlite3
+import threading
+from typing import List, Dict, Optional
+import numpy as np
+from loguru import logger
+
+from backend.app.config import get_settings
+
+settings = get_settings()
+
+
+def content_hash(text: str) -> str:
+    """分块文本的内容哈希"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """基于 SQLite 的向量存储 (float32)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model  TEXT NOT NULL,
+                    hash   TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, hash)
+                ) WITHOUT ROWID
+                """
+            )
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        """批量查询，返回命中的 {hash: embedding}"""
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            # SQLite 变量数有限，分批查询
+            for i in range(0, len(unique), 500):
+                part = unique[i: i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *part],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        """批量写入 {hash: embedding}"""
+        if not items:
+            return
+        rows = [
+            (model, h, np.asarray(vec, dtype=np.float32).tobytes())
+            for h, vec in items.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings(model, hash, vector) VALUES (?, ?, ?)",
+                rows,
+            )
+
+
+_store: Optional[EmbeddingStore] = None
+_store_lock = threading.Lock()
+
+
+def get_embedding_store() -> EmbeddingStore:
+    """获取全局 Embedding 存储"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            os.makedirs(settings.EMBEDDING_STORE_DIR, exist_ok=True)
+            _store = EmbeddingStore(os.path.join(settings.EMBEDDING_STORE_DIR, "embeddings.sqlite3"))
+            logger.info(f"Embedding store opened: {_store.path}")
+        return _store
@@ -2,17 +2,43 @@
 SmartRAG 内容生成器
 支持: LLM-based 生成 & 结构化输出解析
 """
+import re
 import time
-from typing import List, Optional, Dict, AsyncGenerator
+from collections import OrderedDict
+from typing import List, Optional, Dict, AsyncGenerator, Tuple
 from dataclasses import dataclass
 from openai import AsyncOpenAI
 from loguru import logger
 
 from backend.app.core.retriever import RetrievalResult
+from backend.app.core.embedder import close_client_later
 from backend.app.config import get_settings
 
 settings = get_settings()
 
+GENERATION_ERROR_MESSAGE = "抱歉，生成答案时出现错误，请稍后再试。"
+
+# 相同连接配置的 OpenAI 客户端进程内共享 (复用连接池)，超出容量时淘汰最久未使用的，
+# 客户端按调用获取、不被长期持有，淘汰后延迟 LLM_CLIENT_CLOSE_GRACE 秒关闭，等在途请求 / 流式输出结束
+_shared_clients: "OrderedDict[tuple, AsyncOpenAI]" = OrderedDict()
+
+
+def get_shared_client(api_key: str, base_url: str, timeout: Optional[float] = None) -> AsyncOpenAI:
+    """按 (api_key, base_url) 获取共享的 AsyncOpenAI 客户端"""
+    key = (api_key, base_url, timeout)
+    client = _shared_clients.get(key)
+    if client is not None:
+        _shared_clients.move_to_end(key)
+        return client
+
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, **kwargs)
+    _shared_clients[key] = client
+    while len(_shared_clients) > settings.LLM_CLIENT_CACHE_SIZE:
+        _, evicted = _shared_clients.popitem(last=False)
+        close_client_later(evicted, delay=settings.LLM_CLIENT_CLOSE_GRACE)
+    return client
+
 @dataclass
 class GenerationResult:
     """生成结果"""
@@ -27,19 +53,22 @@ class Generator:
     """内容生成器"""
 
     def __init__(self,api_key=None,base_url=None,model_name=None):
-        self.clients = {}  # 存储不同模型的客户端
+        # 存储不同模型的连接配置；客户端每次从共享注册表获取，被淘汰关闭的客户端不会继续被使用
+        self.clients = {}
         print(f"Generator函数初始化")
-        # 只有当api_key和base_url都不为None时，才创建默认客户端
+        # 只有当api_key和base_url都不为None时，才使用默认客户端
         if api_key and base_url:
-            self.default_client = AsyncOpenAI(
-                api_key=api_key,
-                base_url=base_url,
-                timeout=120.0
-            )
+            self.default_client_config = (api_key, base_url, 120.0)
         else:
-            self.default_client = None
+            self.default_client_config = None
         print(f"Generator函数初始化完成")
 
+    @property
+    def default_client(self) -> Optional[AsyncOpenAI]:
+        if self.default_client_config is None:
+            return None
+        return get_shared_client(*self.default_client_config)
+
     def _get_or_create_client(self, model_id: Optional[str] = None,
                               model: Optional[str] = None, api_key: Optional[str] = None,
                               base_url: Optional[str] = None) -> AsyncOpenAI:
@@ -59,24 +88,22 @@ class Generator:
             
             # 这里可以根据model_id从数据库获取模型配置
             # 例如，获取模型的base_url等
-            self.clients[client_key] = AsyncOpenAI(
-                api_key=api_key,
-                base_url=base_url,
-            )
+            self.clients[client_key] = (api_key, base_url)
             logger.info(f"Created new client for model: {client_key}")
         
         logger.info(f"Using client for model: {client_key}")
-        return self.clients[client_key]
+        return get_shared_client(*self.clients[client_key])
 
     def _build_messages(
                 self,
                 query: str,
                 context: str,
-                conversation_history: List[dict]
+                conversation_history: List[dict],
+                judge_relevance: bool = False,
         ) -> List[dict]:
-            """构建消息历史"""
-            from backend.app.core.prompts import GENERATOR_PROMPT
-            system_prompt = GENERATOR_PROMPT
+            """构建消息历史 (judge_relevance: 要求模型在答案前先输出相关性判断)"""
+            from backend.app.core.prompts import GENERATOR_PROMPT, GENERATOR_WITH_RELEVANCE_PROMPT
+            system_prompt = GENERATOR_WITH_RELEVANCE_PROMPT if judge_relevance else GENERATOR_PROMPT
 
             messages = [{"role": "system", "content": system_prompt}]
 
@@ -109,6 +136,28 @@ class Generator:
 
             return messages
 
+    @staticmethod
+    def _split_relevance_verdict(content: str) -> Tuple[bool, str]:
+        """
+        解析单次调用模式的输出：开头为相关性判断，其后为答案
+        只去掉判断词及其后的标点 (模型可能在同一行接着输出答案，如 "有相关内容：答案是…")
+        返回：(是否相关，答案)；模型未按格式输出判断时视为相关，整段作为答案
+        """
+        from backend.app.core.prompts import RELEVANCE_VERDICT_RELEVANT, RELEVANCE_VERDICT_IRRELEVANT
+
+        content = (content or "").strip()
+        # 判断词前允许 Markdown 加粗 / 括号，其后的标点只在同一行内去掉
+        match = re.match(
+            rf"^[*#【\[\s]*({re.escape(RELEVANCE_VERDICT_RELEVANT)}|{re.escape(RELEVANCE_VERDICT_IRRELEVANT)})"
+            rf"(?:\*\*|】|\])?[ \t:：,，;；.。!！、]*",
+            content,
+        )
+        if match is None:
+            return True, content
+        if match.group(1) == RELEVANCE_VERDICT_IRRELEVANT:
+            return False, ""
+        return True, content[match.end():].strip()
+
     async def generate(
                 self,
                 query: str,
@@ -141,21 +190,34 @@ class Generator:
                 # 获取或创建对应模型的客户端
                 client = self._get_or_create_client(model_id, model, api_key, base_url)
 
-                # 第一步：先让模型判断是否有相关内容
-                relevance_check_messages = self._build_relevance_check_messages(query, context)
-                relevance_response = await client.chat.completions.create(
-                    model=model,
-                    messages=relevance_check_messages,
-                    temperature=0.1,  # 降低温度，让判断更严格
-                    max_tokens=50,
-                )
-
-                relevance_result = relevance_response.choices[0].message.content.strip().lower()
                 # 构建引用（无论是否有相关内容，都返回检索到的 chunks）
                 citations = self._build_citations(retrieved_chunks)
 
+                if settings.GENERATION_RELEVANCE_MODE == "two_step":
+                    relevant, response = await self._generate_two_step(
+                        client, query, context, conversation_history, model, temperature, top_p,
+                    )
+                    answer = response.choices[0].message.content if response else ""
+                else:
+                    # 单次调用：模型首行输出相关性判断，其后直接输出答案，上下文只发送一次
+                    response = await client.chat.completions.create(
+                        model=model,
+                        messages=self._build_messages(
+                            query, context, conversation_history or [], judge_relevance=True
+                        ),
+                        temperature=temperature,
+                        top_p=top_p,
+                        max_tokens=1000,
+                    )
+                    relevant, answer = self._split_relevance_verdict(
+                        response.choices[0].message.content
+                    )
+
                 # 如果判断为无相关内容，返回提示但保留引用信息
-                if "no" in relevance_result or "无" in relevance_result:
+                if relevant and not (answer or "").strip():
+                    # 判断为相关却没有输出答案，按生成失败处理 (不缓存)
+                    raise ValueError("模型未输出答案")
+                if not relevant:
                     response_time = time.time() - start_time
                     return GenerationResult(
                         answer="根据提供的信息，未检索到相关内容",
@@ -165,16 +227,6 @@ class Generator:
                         token_usage={"response_time": round(response_time, 2)},
                     )
 
-                # 第二步：有相关内容，生成答案
-                response = await client.chat.completions.create(
-                    model=model,
-                    messages=self._build_messages(query, context, conversation_history or []),
-                    temperature=temperature,
-                    top_p=top_p,
-                    max_tokens=1000,
-                )
-
-                answer = response.choices[0].message.content
                 response_time = time.time() - start_time
                 logger.info(f"大模型汇总回答Answer: {answer}")
 
@@ -202,13 +254,50 @@ class Generator:
                 logger.error(f"Generation failed: {e}")
                 response_time = time.time() - start_time
                 return GenerationResult(
-                    answer="抱歉，生成答案时出现错误，请稍后再试。",
+                    answer=GENERATION_ERROR_MESSAGE,
                     confidence=0.0,
                     citations=[],
                     response_time=response_time,
                     token_usage={"response_time": round(response_time, 2)},
                 )
 
+    async def _generate_two_step(
+            self,
+            client: AsyncOpenAI,
+            query: str,
+            context: str,
+            conversation_history: Optional[List[dict]],
+            model: str,
+            temperature: float,
+            top_p: Optional[float],
+    ):
+            """
+            两步模式：先单独调用一次判断相关性，有相关内容再生成答案
+            返回：(是否相关，答案响应；不相关时为 None)
+            """
+            # 第一步：先让模型判断是否有相关内容
+            relevance_check_messages = self._build_relevance_check_messages(query, context)
+            relevance_response = await client.chat.completions.create(
+                model=model,
+                messages=relevance_check_messages,
+                temperature=0.1,  # 降低温度，让判断更严格
+                max_tokens=50,
+            )
+
+            relevance_result = relevance_response.choices[0].message.content.strip().lower()
+            if "no" in relevance_result or "无" in relevance_result:
+                return False, None
+
+            # 第二步：有相关内容，生成答案
+            response = await client.chat.completions.create(
+                model=model,
+                messages=self._build_messages(query, context, conversation_history or []),
+                temperature=temperature,
+                top_p=top_p,
+                max_tokens=1000,
+            )
+            return True, response
+
     def _build_context(self, retrieved_chunks: List[RetrievalResult]) -> str:
         """构建上下文"""
         if not retrieved_chunks:
@@ -0,0 +1,326 @@
+"""
+SmartRAG 文档解析执行器
+- 解析 + 分块是 CPU 密集的同步操作，不能在事件循环中直接执行
+- thread 模式: 线程池执行 (默认，开销小)
+- process 模式: 每个任务一个独立子进程，不占用 API 进程的 GIL，超时 / 超内存只影响该任务
+"""
+import time
+import asyncio
+import multiprocessing
+from typing import List, Optional, Iterator, AsyncIterator, Set
+from loguru import logger
+
+from backend.app.config import get_settings
+from backend.app.core.document_parser import DocumentParser, disable_page_parallelism, shutdown_pdf_pool
+from backend.app.core.chunker import SmartChunker, Chunk
+
+settings = get_settings()
+
+# 解析器 / 分块器在每个进程 (或线程模式下的主进程) 内各创建一份
+_parser: Optional[DocumentParser] = None
+_chunker: Optional[SmartChunker] = None
+
+
+def _get_parser_and_chunker():
+    global _parser, _chunker
+    if _parser is None:
+        _parser = DocumentParser()
+        _chunker = SmartChunker()
+    return _parser, _chunker
+
+
+def parse_and_chunk(
+    file_path: str,
+    doc_id: str,
+    kb_id: str,
+    chunk_method: str = "smart",
+) -> List[Chunk]:
+    """解析文档并分块 (同步，在 worker 线程 / 进程中执行)"""
+    parser, chunker = _get_parser_and_chunker()
+    parsed = parser.parse(file_path)
+    if not parsed.content.strip():
+        raise ValueError("文档内容为空")
+    return chunker.chunk_document(parsed, doc_id, kb_id, chunk_method)
+
+
+def iter_chunks(
+    file_path: str,
+    doc_id: str,
+    kb_id: str,
+    chunk_method: str = "smart",
+) -> Iterator[Chunk]:
+    """流式解析并分块 (同步生成器)，按页产出分块，不保留整篇文档"""
+    parser, chunker = _get_parser_and_chunker()
+    return chunker.chunk_stream(parser.parse_stream(file_path), doc_id, kb_id, chunk_method)
+
+
+def _next_batch(chunks: Iterator[Chunk], size: int) -> List[Chunk]:
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def _close_chunks(chunks: Iterator[Chunk]):
+    try:
+        chunks.close()
+    except ValueError:
+        # 超时后线程仍在执行生成器，无法关闭，交给线程结束后回收
+        logger.warning("Chunk generator still running, close skipped")
+
+
+def _init_worker(memory_limit_mb: int):
+    """解析进程初始化: 设置地址空间上限 (仅 POSIX 支持)"""
+    if memory_limit_mb <= 0:
+        return
+    try:
+        import resource
+    except ImportError:
+        return
+    limit = memory_limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _send_result(conn, result: tuple):
+    try:
+        conn.send(result)
+    except Exception as e:
+        # 异常对象 / 结果无法序列化时只返回描述
+        error = result[1] if result[0] == "error" else e
+        conn.send(("error", RuntimeError(f"{type(error).__name__}: {error}")))
+
+
+def _parse_entry(conn, memory_limit_mb: int, args: tuple):
+    """解析子进程入口: 结果或异常通过管道返回给父进程"""
+    _init_worker(memory_limit_mb)
+    disable_page_parallelism()
+    try:
+        result = ("ok", parse_and_chunk(*args))
+    except BaseException as e:
+        result = ("error", e)
+    try:
+        _send_result(conn, result)
+    finally:
+        conn.close()
+
+
+def _stream_entry(conn, memory_limit_mb: int, args: tuple, batch_size: int):
+    """
+    流式解析子进程入口: 边解析边按批通过管道发送 ("batch", chunks)，结束时发送 ("done", None)
+    管道缓冲区写满后 send 阻塞，父进程消费慢时子进程随之暂停解析，内存不会无限增长
+    """
+    _init_worker(memory_limit_mb)
+    disable_page_parallelism()
+    try:
+        chunks = iter_chunks(*args)
+        while True:
+            batch = _next_batch(chunks, batch_size)
+            if not batch:
+                break
+            conn.send(("batch", batch))
+        result = ("done", None)
+    except BaseException as e:
+        result = ("error", e)
+    try:
+        _send_result(conn, result)
+    finally:
+        conn.close()
+
+
+def _receive(conn):
+    """阻塞等待子进程结果 (在线程中执行)，子进程退出而未返回结果时抛出 EOFError"""
+    try:
+        return conn.recv()
+    finally:
+        conn.close()
+
+
+# 每个解析任务独立一个子进程: 超时 / 超内存只结束该任务自己的进程，不影响其他任务
+# 使用 spawn 启动，避免 fork 多线程的 API 进程
+_mp_context = multiprocessing.get_context("spawn")
+_processes: Set[multiprocessing.process.BaseProcess] = set()
+_slots: Optional[asyncio.Semaphore] = None
+
+
+def _get_slots() -> asyncio.Semaphore:
+    """限制同时运行的解析进程数为 PARSE_WORKERS"""
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(max(1, settings.PARSE_WORKERS))
+    return _slots
+
+
+def shutdown_parse_pool():
+    """结束所有执行中的解析进程，并关闭 PDF 页解析进程池"""
+    for process in list(_processes):
+        if process.is_alive():
+            process.kill()
+    _processes.clear()
+    shutdown_pdf_pool()
+
+
+async def _run_in_process(args: tuple, timeout: Optional[int]) -> List[Chunk]:
+    async with _get_slots():
+        receiver, sender = _mp_context.Pipe(duplex=False)
+        process = _mp_context.Process(
+            target=_parse_entry,
+            args=(sender, settings.PARSE_MEMORY_LIMIT_MB, args),
+            daemon=True,
+        )
+        process.start()
+        sender.close()
+        _processes.add(process)
+        try:
+            status, payload = await asyncio.wait_for(asyncio.to_thread(_receive, receiver), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"文档解析超时 ({settings.PARSE_TIMEOUT}s)")
+        except EOFError:
+            await asyncio.to_thread(process.join, 5)
+            raise RuntimeError(
+                f"文档解析进程异常退出 (exitcode={process.exitcode}，可能超出内存上限 "
+                f"{settings.PARSE_MEMORY_LIMIT_MB}MB)"
+            )
+        finally:
+            # 超时 / 取消时结束子进程，管道关闭后等待结果的线程随之退出
+            if process.is_alive():
+                process.kill()
+            await asyncio.to_thread(process.join)
+            _processes.discard(process)
+
+    if status == "ok":
+        return payload
+    _raise_child_error(payload)
+
+
+def _raise_child_error(error: BaseException):
+    if isinstance(error, MemoryError):
+        raise RuntimeError(f"文档解析超出内存上限 ({settings.PARSE_MEMORY_LIMIT_MB}MB)")
+    raise error
+
+
+async def _stream_in_process(
+    args: tuple,
+    batch_size: int,
+    timeout: Optional[int],
+) -> AsyncIterator[List[Chunk]]:
+    """
+    子进程流式解析，按批接收分块
+    超时只累计等待子进程产出的时间 (与 thread 模式一致)，调用方处理批次期间子进程被管道阻塞
+    """
+    async with _get_slots():
+        receiver, sender = _mp_context.Pipe(duplex=False)
+        process = _mp_context.Process(
+            target=_stream_entry,
+            args=(sender, settings.PARSE_MEMORY_LIMIT_MB, args, batch_size),
+            daemon=True,
+        )
+        process.start()
+        sender.close()
+        _processes.add(process)
+        pending: Optional[asyncio.Future] = None
+        elapsed = 0.0
+        try:
+            while True:
+                remaining = timeout - elapsed if timeout else None
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"文档解析超时 ({settings.PARSE_TIMEOUT}s)")
+                started = time.monotonic()
+                # 不用 wait_for: 超时 / 取消时接收线程仍在读管道，需等子进程结束后再回收
+                pending = asyncio.ensure_future(asyncio.to_thread(receiver.recv))
+                done, _ = await asyncio.wait({pending}, timeout=remaining)
+                elapsed += time.monotonic() - started
+                if not done:
+                    raise TimeoutError(f"文档解析超时 ({settings.PARSE_TIMEOUT}s)")
+                try:
+                    status, payload = pending.result()
+                except EOFError:
+                    await asyncio.to_thread(process.join, 5)
+                    raise RuntimeError(
+                        f"文档解析进程异常退出 (exitcode={process.exitcode}，可能超出内存上限 "
+                        f"{settings.PARSE_MEMORY_LIMIT_MB}MB)"
+                    )
+                finally:
+                    pending = None
+                if status == "done":
+                    return
+                if status == "error":
+                    _raise_child_error(payload)
+                yield payload
+        finally:
+            # 超时 / 取消 / 调用方提前停止时结束子进程，管道关闭后接收线程随之退出
+            if process.is_alive():
+                process.kill()
+            await asyncio.to_thread(process.join)
+            _processes.discard(process)
+            if pending is not None:
+                await asyncio.gather(pending, return_exceptions=True)
+            receiver.close()
+
+
+async def run_parse_and_chunk(
+    file_path: str,
+    doc_id: str,
+    kb_id: str,
+    chunk_method: str = "smart",
+) -> List[Chunk]:
+    """按 PARSE_EXECUTOR_MODE 在线程池或独立子进程中解析并分块，超过 PARSE_TIMEOUT 秒视为失败"""
+    timeout = settings.PARSE_TIMEOUT or None
+    args = (file_path, doc_id, kb_id, chunk_method)
+
+    if settings.PARSE_EXECUTOR_MODE != "process":
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(parse_and_chunk, *args), timeout)
+        except asyncio.TimeoutError:
+            # 线程无法强制终止，只能放弃等待结果
+            raise TimeoutError(f"文档解析超时 ({settings.PARSE_TIMEOUT}s)")
+
+    return await _run_in_process(args, timeout)
+
+
+async def stream_parse_and_chunk(
+    file_path: str,
+    doc_id: str,
+    kb_id: str,
+    chunk_method: str = "smart",
+    batch_size: int = 64,
+) -> AsyncIterator[List[Chunk]]:
+    """
+    按批产出分块，调用方可以边解析边向量化 / 入库，内存只与批大小相关
+    - thread 模式: 在线程中逐批拉取流式分块，解析累计耗时超过 PARSE_TIMEOUT 视为失败
+    - process 模式: 子进程流式解析，每产出一批即通过管道发送 (管道满时子进程阻塞，形成背压)
+    """
+    if settings.PARSE_EXECUTOR_MODE == "process":
+        batches = _stream_in_process(
+            (file_path, doc_id, kb_id, chunk_method), batch_size, settings.PARSE_TIMEOUT or None
+        )
+        try:
+            async for batch in batches:
+                yield batch
+        finally:
+            await batches.aclose()
+        return
+
+    chunks = iter_chunks(file_path, doc_id, kb_id, chunk_method)
+    elapsed = 0.0
+    try:
+        while True:
+            remaining = settings.PARSE_TIMEOUT - elapsed if settings.PARSE_TIMEOUT else None
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"文档解析超时 ({settings.PARSE_TIMEOUT}s)")
+            started = time.monotonic()
+            try:
+                batch = await asyncio.wait_for(
+                    asyncio.to_thread(_next_batch, chunks, batch_size), remaining
+                )
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"文档解析超时 ({settings.PARSE_TIMEOUT}s)")
+            elapsed += time.monotonic() - started
+            if not batch:
+                break
+            yield batch
+    finally:
+        # 调用方提前停止时在线程中关闭同步生成器 (释放文件句柄、取消 PDF 批次)，
+        # 避免由事件循环线程上的 GC 执行清理
+        await asyncio.to_thread(_close_chunks, chunks)
@@ -0,0 +1,147 @@
+"""
+SmartRAG 检索权限范围
+- 一次联表查询得到角色在给定知识库集合内可检索的知识库与文档
+- 结果按 (角色, 知识库集合) 进程内缓存，权限 / 文档变更时按知识库失效，TTL 兜底
+- 检索结果的分块级权限过滤同样只用一次批量查询
+"""
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple, FrozenSet, Set
+from loguru import logger
+from sqlalchemy import select, and_, or_, exists
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.app.config import get_settings
+from backend.app.models.document import Document, DocumentChunk, DocumentRole
+from backend.app.models.knowledge_base import KnowledgeBase, KnowledgeBaseRole
+
+settings = get_settings()
+
+ScopeKey = Tuple[str, FrozenSet[str]]
+Scope = Tuple[Tuple[str, ...], Tuple[str, ...]]
+
+
+class PermissionScopeCache:
+    """权限范围缓存 - key 为 (角色, 知识库集合)"""
+
+    def __init__(self, max_size: int = 1024, ttl: int = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[ScopeKey, Tuple[float, Scope]]" = OrderedDict()
+
+    def get(self, key: ScopeKey) -> Optional[Scope]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, scope = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return scope
+
+    def set(self, key: ScopeKey, scope: Scope):
+        self._data[key] = (time.monotonic() + self.ttl, scope)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, kb_id: Optional[str] = None):
+        """使包含该知识库的缓存失效，kb_id 为空时清空全部"""
+        if kb_id is None:
+            self._data.clear()
+            return
+        for key in [key for key in self._data if kb_id in key[1]]:
+            del self._data[key]
+
+
+permission_scope_cache = PermissionScopeCache(
+    max_size=settings.PERMISSION_SCOPE_CACHE_SIZE,
+    ttl=settings.PERMISSION_SCOPE_CACHE_TTL,
+)
+
+
+async def resolve_permission_scope(
+    db: AsyncSession,
+    role_id: Optional[str],
+    kb_ids: List[str],
+) -> Tuple[List[str], Optional[List[str]]]:
+    """
+    计算角色可检索的范围
+    - 知识库: 目标知识库中未删除、且角色拥有知识库权限的
+    - 文档: 上述知识库中未删除、且角色拥有文档权限的
+    返回：(知识库 ID 列表，文档 ID 列表；没有任何文档授权时为 None，表示不按文档过滤)
+    """
+    if not role_id or not kb_ids:
+        return [], None
+
+    key = (role_id, frozenset(kb_ids))
+    scope = permission_scope_cache.get(key)
+    if scope is None:
+        # 知识库权限内连接，文档权限左连接：有知识库权限但没有文档授权的知识库也会返回一行 (doc_id 为空)
+        granted_docs = select(DocumentRole.doc_id).where(
+            DocumentRole.role_id == role_id,
+            DocumentRole.is_deleted == False,
+        )
+        result = await db.execute(
+            select(KnowledgeBase.id, Document.id)
+            .join(
+                KnowledgeBaseRole,
+                and_(
+                    KnowledgeBaseRole.kb_id == KnowledgeBase.id,
+                    KnowledgeBaseRole.role_id == role_id,
+                    KnowledgeBaseRole.is_deleted == False,
+                ),
+            )
+            .outerjoin(
+                Document,
+                and_(
+                    Document.kb_id == KnowledgeBase.id,
+                    Document.is_deleted == False,
+                    Document.id.in_(granted_docs),
+                ),
+            )
+            .where(KnowledgeBase.id.in_(kb_ids), KnowledgeBase.is_deleted == False)
+            .distinct()
+        )
+        authorized_kb_ids = set()
+        authorized_doc_ids = set()
+        for kb_id, doc_id in result.all():
+            authorized_kb_ids.add(kb_id)
+            if doc_id is not None:
+                authorized_doc_ids.add(doc_id)
+        scope = (tuple(sorted(authorized_kb_ids)), tuple(sorted(authorized_doc_ids)))
+        permission_scope_cache.set(key, scope)
+        logger.info(
+            f"[Permission] role={role_id}: {len(scope[0])} knowledge bases, {len(scope[1])} documents authorized"
+        )
+
+    kb_scope, doc_scope = scope
+    return list(kb_scope), list(doc_scope) if doc_scope else None
+
+
+async def filter_authorized_chunk_ids(db: AsyncSession, user, chunk_ids: List[str]) -> Set[str]:
+    """
+    一次查询过滤出用户有权限访问的分块
+    - 分块所属文档、知识库均未删除
+    - 用户是知识库所有者，或用户角色拥有该文档的权限
+    """
+    if not chunk_ids:
+        return set()
+
+    conditions = [KnowledgeBase.owner_id == user.id]
+    if user.role_id:
+        conditions.append(
+            exists().where(
+                DocumentRole.doc_id == Document.id,
+                DocumentRole.role_id == user.role_id,
+                DocumentRole.is_deleted == False,
+            )
+        )
+    result = await db.execute(
+        select(DocumentChunk.id)
+        .join(Document, and_(Document.id == DocumentChunk.doc_id, Document.is_deleted == False))
+        .join(KnowledgeBase, and_(KnowledgeBase.id == Document.kb_id, KnowledgeBase.is_deleted == False))
+        .where(DocumentChunk.id.in_(chunk_ids), or_(*conditions))
+    )
+    return set(result.scalars().all())
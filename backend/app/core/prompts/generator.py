@@ -22,3 +22,19 @@ RELEVANCE_JUDGMENT_PROMPT = """你是一个严格的相关性判断助手。你
 - 只输出 "有相关内容" 或 "无相关内容"，不要输出任何其他内容
 """
 
+
+RELEVANCE_VERDICT_RELEVANT = "有相关内容"
+RELEVANCE_VERDICT_IRRELEVANT = "无相关内容"
+
+# 单次调用模式：相关性判断与回答合并，首行输出判断结果，其后为答案
+GENERATOR_WITH_RELEVANCE_PROMPT = GENERATOR_PROMPT + f"""
+回答前先判断【参考信息】是否包含与【问题】直接相关的内容：
+1. 如果问题问的是具体的人/事/物 A，但参考信息只提到 B（即使 A 和 B 很相似），也属于"{RELEVANCE_VERDICT_IRRELEVANT}"
+2. 不要做任何推断，只做字面匹配
+3. 如果参考信息中没有直接提到问题中的关键词，属于 "{RELEVANCE_VERDICT_IRRELEVANT}"
+4. 如果参考信息中直接提到了问题中的关键词，属于 "{RELEVANCE_VERDICT_RELEVANT}"
+
+输出格式：
+- 第一行只输出 "{RELEVANCE_VERDICT_RELEVANT}" 或 "{RELEVANCE_VERDICT_IRRELEVANT}"
+- 如果是 "{RELEVANCE_VERDICT_RELEVANT}"，从第二行开始输出答案；如果是 "{RELEVANCE_VERDICT_IRRELEVANT}"，不要输出任何其他内容
+"""
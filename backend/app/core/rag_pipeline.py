@@ -3,17 +3,52 @@ SmartRAG 全流程编排器
 Query → Retrieval → Rerank → Generation → Output
 """
 import json
+import time
+import asyncio
+from dataclasses import asdict
 from typing import List, Optional, Tuple
 from loguru import logger
 from sqlalchemy.ext.asyncio import AsyncSession
 from backend.app.core.retriever import HybridRetriever, RetrievalResult
 from backend.app.core.reranker import Reranker
-from backend.app.core.generator import Generator, GenerationResult
+from backend.app.core.generator import Generator, GenerationResult, GENERATION_ERROR_MESSAGE
+from backend.app.core.answer_cache import answer_cache
+from backend.app.core.permission_scope import resolve_permission_scope, filter_authorized_chunk_ids
 from backend.app.config import get_settings
 from sqlalchemy import select, text
 
 settings = get_settings()
 
+_neo4j_driver = None
+_neo4j_checked_at: Optional[float] = None
+
+
+def get_neo4j_driver():
+    """获取共享的 Neo4j 驱动；连接失败时 60 秒内不再重试"""
+    global _neo4j_driver, _neo4j_checked_at
+    if _neo4j_driver is not None:
+        return _neo4j_driver
+    if _neo4j_checked_at is not None and time.monotonic() - _neo4j_checked_at < 60:
+        return None
+    _neo4j_checked_at = time.monotonic()
+    try:
+        from neo4j import GraphDatabase
+
+        driver = GraphDatabase.driver(
+            settings.NEO4J_URL,
+            auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD)
+        )
+        # 测试连接
+        with driver.session() as session:
+            session.run("MATCH (n) RETURN count(n) LIMIT 1")
+        logger.info("Neo4j connection established successfully")
+        _neo4j_driver = driver
+    except Exception as e:
+        logger.warning(f"Failed to initialize Neo4j driver: {e}")
+        logger.warning("Using mock data for graph database queries")
+    return _neo4j_driver
+
+
 class RAGPipeline:
     """RAG 全流程编排"""
 
@@ -29,24 +64,8 @@ class RAGPipeline:
         self.db = db
         self.pm_db = pm_db
         
-        # 初始化Neo4j驱动
-        try:
-            from neo4j import GraphDatabase
-            from backend.app.config import get_settings
-            
-            settings = get_settings()
-            self.neo4j_driver = GraphDatabase.driver(
-                settings.NEO4J_URL,
-                auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD)
-            )
-            # 测试连接
-            with self.neo4j_driver.session() as session:
-                session.run("MATCH (n) RETURN count(n) LIMIT 1")
-            logger.info("Neo4j connection established successfully")
-        except Exception as e:
-            logger.warning(f"Failed to initialize Neo4j driver: {e}")
-            logger.warning("Using mock data for graph database queries")
-            self.neo4j_driver = None
+        # Neo4j驱动进程内共享，避免每次创建 pipeline 都重新建立连接
+        self.neo4j_driver = get_neo4j_driver()
 
     async def _detect_query_intent(
         self,
@@ -274,6 +293,92 @@ class RAGPipeline:
             return query, []
 
 
+    async def _authorize_scope(
+        self,
+        kb_ids: List[str],
+        db=None,
+        user=None,
+    ) -> Tuple[List[str], Optional[List[str]]]:
+        """
+        权限前置检查 (一次联表查询，按角色 + 知识库集合缓存)
+        未传入用户时 kb_ids 视为调用方已授权的范围，原样使用、不按文档过滤
+        (API 授权码访问在调用前已校验知识库授权；评估接口检索指定的知识库)
+        返回：(有权限的知识库 ID 列表，有权限的文档 ID 列表；None 表示不按文档过滤)
+        """
+        if user is None:
+            logger.info(f"[RAG] No user context, using caller-authorized scope: {kb_ids}")
+            return list(kb_ids), None
+        if db is None:
+            raise ValueError("按用户过滤检索范围需要数据库会话")
+
+        logger.info("[RAG] Pre-filtering authorized documents")
+        return await resolve_permission_scope(db, user.role_id, kb_ids)
+
+    async def _embed_for_cache(self, query: str) -> Optional[List[float]]:
+        """问答缓存用的查询向量 (与检索共用查询向量缓存)，失败时跳过缓存"""
+        try:
+            return await self.retriever.vector_store.embedder.embed_query(query)
+        except Exception as e:
+            logger.warning(f"[RAG] Answer cache skipped, query embedding failed: {e}")
+            return None
+
+    @staticmethod
+    async def _cache_answer(
+        scope: Optional[str],
+        embedding: Optional[List[float]],
+        result: GenerationResult,
+    ):
+        """缓存知识库问答结果 (生成失败的结果不缓存)"""
+        if not scope or embedding is None:
+            return
+        if result.answer == GENERATION_ERROR_MESSAGE:
+            return
+        await answer_cache.store(scope, embedding, asdict(result))
+
+    @staticmethod
+    async def _cancel_tasks(*tasks: Optional[asyncio.Task]):
+        """取消推测执行中用不到的任务"""
+        pending = [task for task in tasks if task is not None and not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    @staticmethod
+    def _merge_retrievals(
+        *result_lists: List[RetrievalResult],
+        top_k: int,
+        k: int = 60,
+    ) -> List[RetrievalResult]:
+        """
+        多路查询检索结果 RRF 融合 (改写查询 + 原始查询)
+        score = sum(1/(k + rank))，向量 / BM25 分数取各路最高值
+        """
+        merged: dict = {}
+        for results in result_lists:
+            for rank, r in enumerate(results):
+                item = merged.setdefault(r.chunk_id, {
+                    "result": r,
+                    "rrf_score": 0.0,
+                    "vector_score": r.vector_score,
+                    "bm25_score": r.bm25_score,
+                })
+                item["rrf_score"] += 1.0 / (k + rank + 1)
+                item["vector_score"] = max(item["vector_score"], r.vector_score)
+                item["bm25_score"] = max(item["bm25_score"], r.bm25_score)
+
+        ranked = sorted(merged.values(), key=lambda x: x["rrf_score"], reverse=True)[:top_k]
+        return [
+            RetrievalResult(
+                chunk_id=item["result"].chunk_id,
+                content=item["result"].content,
+                score=item["rrf_score"],
+                vector_score=item["vector_score"],
+                bm25_score=item["bm25_score"],
+                metadata=item["result"].metadata,
+            )
+            for item in ranked
+        ]
+
     async def run(
                 self,
                 query: str,
@@ -299,15 +404,78 @@ class RAGPipeline:
             processed_query = replace_relative_time_in_query(query)
             logger.info(f"[RAG] Starting - original query='{query[:50]}...', processed query='{processed_query[:50]}...', kb_ids={kb_ids}")
 
-            # ── 新增：意图检测 ──
-            intent = await self._detect_query_intent(
+            raw_query = processed_query
+            started_at = time.time()
+
+            # ── 推测执行：意图检测、查询改写、原始查询检索同时启动，意图确定后取消用不到的任务 ──
+            # 意图 / 改写的 LLM 调用最先启动，与问答缓存查找 (权限检查 + 查询向量) 并发，缓存命中时取消
+            intent_task = asyncio.create_task(self._detect_query_intent(
                 query=processed_query,
                 model=model,
                 api_key=api_key,
                 base_url=base_url,
                 model_id=model_id
-            )
-            
+            ))
+            rewrite_task = None
+            retrieval_task = None
+            if settings.ENABLE_QUERY_REWRITE:
+                rewrite_task = asyncio.create_task(self._rewrite_query_with_llm(
+                    query=processed_query,
+                    domain=domain,
+                    model=model,
+                    api_key=api_key,
+                    model_id=model_id
+                ))
+            try:
+                # ── 问答缓存：相同权限范围内的相近问题直接复用答案 (多轮对话依赖上下文，不走缓存) ──
+                authorized = None
+                cache_scope = query_embedding = None
+                if answer_cache.enabled and not conversation_history:
+                    authorized, query_embedding = await asyncio.gather(
+                        self._authorize_scope(kb_ids, db, user),
+                        self._embed_for_cache(processed_query),
+                    )
+                    if query_embedding is not None:
+                        cache_scope = await answer_cache.make_scope(
+                            model=model_id or model,
+                            kb_ids=authorized[0],
+                            doc_ids=authorized[1],
+                            top_k=top_k,
+                            retrieval_mode=retrieval_mode,
+                            domain=domain,
+                            use_llm=use_llm,
+                        )
+                    if cache_scope:
+                        cached = await answer_cache.lookup(cache_scope, query_embedding)
+                        if cached is not None:
+                            await self._cancel_tasks(intent_task, rewrite_task)
+                            result = GenerationResult(**cached)
+                            result.response_time = time.time() - started_at
+                            result.token_usage = {**result.token_usage, "response_time": round(result.response_time, 2)}
+                            return result
+
+                # 权限前置检查与 LLM 调用并发进行，完成后立即用原始查询开始检索
+                authorized_kb_ids, authorized_doc_ids = (
+                    authorized or await self._authorize_scope(kb_ids, db, user)
+                )
+                retrieval_task = asyncio.create_task(self.retriever.retrieve(
+                    query=raw_query,
+                    kb_ids=authorized_kb_ids,
+                    top_k=settings.RETRIEVAL_TOP_K,
+                    mode=retrieval_mode,
+                    domain=domain,
+                    doc_ids=authorized_doc_ids,
+                ))
+                intent = await intent_task
+            except BaseException:
+                await self._cancel_tasks(intent_task, rewrite_task, retrieval_task)
+                raise
+
+            if (intent == 'database' and pm_db) or intent == 'graph_database':
+                # 走数据库问答，知识库链路的改写 / 检索用不到了
+                await self._cancel_tasks(rewrite_task, retrieval_task)
+                rewrite_task = retrieval_task = None
+
             # 如果是数据库查询意图
             if intent == 'database' and pm_db:
                 logger.info(f"[RAG] Database query intent detected")
@@ -347,7 +515,6 @@ class RAGPipeline:
                     logger.info(f"[RAG] Database query completed successfully")
                     
                     # 构建返回结果
-                    from backend.app.core.generator import GenerationResult
                     return GenerationResult(
                         answer=answer,
                         confidence=0.9,
@@ -398,7 +565,6 @@ class RAGPipeline:
                     logger.info(f"[RAG] Graph database query completed successfully")
                     
                     # 构建返回结果
-                    from backend.app.core.generator import GenerationResult
                     return GenerationResult(
                         answer=answer,
                         confidence=0.9,
@@ -415,120 +581,62 @@ class RAGPipeline:
             # 保留之前处理过的查询
             if settings.ENABLE_QUERY_REWRITE:
                 logger.info(f"[RAG] Stage 1: Query Rewriting")
-                processed_query, expanded_queries = await self._rewrite_query_with_llm(
-                    query=processed_query,
-                    domain=domain,
-                    model=model,
-                    api_key=api_key,
-                    model_id=model_id
-                )
+                try:
+                    if rewrite_task is not None:
+                        processed_query, expanded_queries = await rewrite_task
+                    else:
+                        # 数据库问答失败回退到知识库时，推测任务已被取消
+                        processed_query, expanded_queries = await self._rewrite_query_with_llm(
+                            query=processed_query,
+                            domain=domain,
+                            model=model,
+                            api_key=api_key,
+                            model_id=model_id
+                        )
+                except BaseException:
+                    await self._cancel_tasks(retrieval_task)
+                    raise
             else:
                 expanded_queries = []
 
-            # ── 新增：权限前置检查 ──
-            authorized_doc_ids = None
-            authorized_kb_ids = None
-            if db and user:
-                logger.info("[RAG] Pre-filtering authorized documents")
-                from backend.app.models.document import Document, DocumentRole
-                from backend.app.models.knowledge_base import KnowledgeBase, KnowledgeBaseRole
-
-                authorized_doc_ids = set()
-                authorized_kb_ids = set()
-
-                # 1. 获取所有相关知识库
-                kb_result = await db.execute(
-                    select(KnowledgeBase).where(
-                        (KnowledgeBase.id.in_(kb_ids)) &
-                        (KnowledgeBase.is_deleted == False)
-                    )
-                )
-                knowledge_bases = kb_result.scalars().all()
-
-                for kb in knowledge_bases:
-                    # 2. 知识库所有者
-                    # if kb.owner_id == user.id:
-                    #     # 获取该知识库下所有文档
-                    #     doc_result = await db.execute(
-                    #         select(Document.id).where(
-                    #             (Document.kb_id == kb.id) &
-                    #             (Document.is_deleted == False)
-                    #         )
-                    #     )
-                    #     for doc_id in doc_result.scalars().all():
-                    #         authorized_doc_ids.add(doc_id)
-                    # elif user.role_id:
-                    #     # 3. 通过角色授权的知识库
-                    #     kb_role_result = await db.execute(
-                    #         select(KnowledgeBaseRole).where(
-                    #             (KnowledgeBaseRole.kb_id == kb.id) &
-                    #             (KnowledgeBaseRole.role_id == user.role_id) &
-                    #             (KnowledgeBaseRole.is_deleted == False)
-                    #         )
-                    #     )
-                    #     if kb_role_result.scalar_one_or_none():
-                    #         # 有知识库权限，获取所有文档
-                    #         doc_result = await db.execute(
-                    #             select(Document.id).where(
-                    #                 (Document.kb_id == kb.id) &
-                    #                 (Document.is_deleted == False)
-                    #             )
-                    #         )
-                    #         for doc_id in doc_result.scalars().all():
-                    #             authorized_doc_ids.add(doc_id)
-                    #     else:
-                            # 4. 单独的文档权限
-                            has_kb_permission = False
-                            kb_role_result = await db.execute(
-                                select(KnowledgeBaseRole).where(
-                                    (KnowledgeBaseRole.kb_id == kb.id) &
-                                    (KnowledgeBaseRole.role_id == user.role_id) &
-                                    (KnowledgeBaseRole.is_deleted == False)
-                                )
-                            )
-                            if kb_role_result.scalar_one_or_none():
-                                has_kb_permission = True
-                                authorized_kb_ids.add(kb.id)
-
-                            if not has_kb_permission:
-                                continue
-
-                            doc_role_result = await db.execute(
-                                select(DocumentRole.doc_id).where(
-                                    (DocumentRole.role_id == user.role_id) &
-                                    (DocumentRole.is_deleted == False)
-                                )
-                            )
-                            for doc_id in doc_role_result.scalars().all():
-                                # 验证文档是否在目标知识库中
-                                doc_check = await db.execute(
-                                    select(Document.kb_id).where(
-                                        (Document.id == doc_id) &
-                                        (Document.is_deleted == False)
-                                    )
-                                )
-                                doc_kb_id = doc_check.scalar_one_or_none()
-                                if doc_kb_id == kb.id and has_kb_permission:
-                                    authorized_doc_ids.add(doc_id)
-
-                logger.info(f"[RAG] Authorized {len(authorized_doc_ids)} documents")
-                authorized_doc_ids = list(authorized_doc_ids) if authorized_doc_ids else None
-
             # ── Stage 2: 检索 ──
             logger.info(f"[RAG] Stage 2: Retrieval - query='{processed_query[:50]}', domain={domain}")
-            retrieved = await self.retriever.retrieve(
-                query=processed_query,
-                kb_ids=list(authorized_kb_ids),
-                top_k=settings.RETRIEVAL_TOP_K,
-                mode=retrieval_mode,
-                domain=domain,
-                doc_ids=authorized_doc_ids,
-            )
+            if retrieval_task is not None and processed_query == raw_query:
+                # 改写未改变查询，直接复用推测执行的原始查询检索结果
+                retrieved = await retrieval_task
+            else:
+                rewritten_task = asyncio.create_task(self.retriever.retrieve(
+                    query=processed_query,
+                    kb_ids=authorized_kb_ids,
+                    top_k=settings.RETRIEVAL_TOP_K,
+                    mode=retrieval_mode,
+                    domain=domain,
+                    doc_ids=authorized_doc_ids,
+                ))
+                try:
+                    retrieved = await rewritten_task
+                except BaseException:
+                    await self._cancel_tasks(retrieval_task)
+                    raise
+                if retrieval_task is not None:
+                    # 推测执行的原始查询检索不丢弃，与改写查询的结果做 RRF 融合
+                    try:
+                        raw_retrieved = await retrieval_task
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.warning(f"[RAG] Speculative raw-query retrieval failed, using rewritten results only: {e}")
+                    else:
+                        retrieved = self._merge_retrievals(
+                            retrieved, raw_retrieved,
+                            top_k=settings.RETRIEVAL_TOP_K,
+                            k=self.retriever.rrf_k,
+                        )
             logger.info(f"[RAG] Retrieved {len(retrieved)} chunks")
 
             if not retrieved:
                 logger.warning("[RAG] No chunks retrieved")
-                return await self.generator.generate(
+                result = await self.generator.generate(
                     query=processed_query,
                     retrieved_chunks=[],
                     conversation_history=conversation_history,
@@ -539,6 +647,8 @@ class RAGPipeline:
                     api_key=api_key,
                     base_url=base_url
                 )
+                await self._cache_answer(cache_scope, query_embedding, result)
+                return result
 
             # ── Stage 3: 重排序 ──
             filtered = retrieved
@@ -586,6 +696,7 @@ class RAGPipeline:
                     f"time={result.response_time:.2f}s"
                 )
 
+                await self._cache_answer(cache_scope, query_embedding, result)
                 return result
             else:
                 results = []
@@ -616,13 +727,15 @@ class RAGPipeline:
                         "score": result.score,
                     }
                     results.append(json.dumps(result_dict, ensure_ascii=False, indent=None))
-                return GenerationResult(
+                result = GenerationResult(
                     answer="\n".join(results),
                     confidence=0.0,
                     citations=[],
                     response_time=0.0,
                     token_usage={}
                 )
+                await self._cache_answer(cache_scope, query_embedding, result)
+                return result
 
 
     async def run_stream(
@@ -767,61 +880,17 @@ class RAGPipeline:
             domain=domain,  # 传递领域参数
         )
 
-        # ── 权限检查 ──
+        # ── 权限检查 (一次批量查询过滤全部检索结果) ──
         if db and user:
             logger.info("[RAG Stream] Checking document permissions")
-            from backend.app.models.document import Document, DocumentChunk
-            from backend.app.models.knowledge_base import KnowledgeBase
-            from sqlalchemy import select
-            
-            # 过滤出用户有权限的chunks
-            authorized_chunks = []
-            
-            for chunk in retrieved:
-                try:
-                    # 获取chunk对应的文档ID
-                    chunk_result = await db.execute(
-                        select(DocumentChunk.doc_id).where(DocumentChunk.id == chunk.chunk_id)
-                    )
-                    doc_id = chunk_result.scalar_one_or_none()
-                    
-                    if doc_id:
-                        # 获取文档信息
-                        doc_result = await db.execute(
-                            select(Document).where(Document.id == doc_id, Document.is_deleted == False)
-                        )
-                        doc = doc_result.scalar_one_or_none()
-                        
-                        if doc:
-                            # 获取知识库信息
-                            kb_result = await db.execute(
-                                select(KnowledgeBase).where(KnowledgeBase.id == doc.kb_id, KnowledgeBase.is_deleted == False)
-                            )
-                            kb = kb_result.scalar_one_or_none()
-                            
-                            if kb:
-                                # 检查权限
-                                if kb.owner_id == user.id:
-                                    # 用户是知识库所有者，有权限
-                                    authorized_chunks.append(chunk)
-                                else:
-                                    # 检查用户角色是否有权限
-                                    if user.role_id:
-                                        from backend.app.models.document import DocumentRole
-                                        role_result = await db.execute(
-                                            select(DocumentRole).where(
-                                                DocumentRole.doc_id == doc_id,
-                                                DocumentRole.role_id == user.role_id,
-                                                DocumentRole.is_deleted == False
-                                            )
-                                        )
-                                        if role_result.scalar_one_or_none():
-                                            # 用户角色有权限
-                                            authorized_chunks.append(chunk)
-                except Exception as e:
-                    logger.error(f"Permission check failed for chunk {chunk.chunk_id}: {e}")
-            
-            retrieved = authorized_chunks
+            try:
+                authorized_ids = await filter_authorized_chunk_ids(
+                    db, user, [chunk.chunk_id for chunk in retrieved]
+                )
+            except Exception as e:
+                logger.error(f"Permission check failed: {e}")
+                authorized_ids = set()
+            retrieved = [chunk for chunk in retrieved if chunk.chunk_id in authorized_ids]
             logger.info(f"[RAG Stream] After permission check: {len(retrieved)} chunks")
 
         # 重排序
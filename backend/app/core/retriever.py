@@ -6,20 +6,30 @@ SmartRAG 混合检索引擎
 - 查询扩展与优化
 """
 import re
+import heapq
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
 from dataclasses import dataclass
 from loguru import logger
 
-from rank_bm25 import BM25Okapi
 import jieba
 import jieba.analyse
 
-from backend.app.core.vector_store import VectorStore, SearchResult
+from backend.app.core.vector_store import get_vector_store, SearchResult
+from backend.app.core.bm25_index import tokenize
 from backend.app.config import get_settings
 from backend.app.core.domain_strategies import domain_strategies, default_strategy
 
 settings = get_settings()
 
+# BM25 打分是 CPU 密集的同步操作，放到独立线程池执行，避免阻塞事件循环
+_keyword_executor = ThreadPoolExecutor(
+    max_workers=settings.KEYWORD_SEARCH_WORKERS,
+    thread_name_prefix="bm25-search",
+)
+
 @dataclass
 class RetrievalResult:
     """检索结果 (含融合分数)"""
@@ -35,7 +45,7 @@ class HybridRetriever:
     """混合检索器"""
 
     def __init__(self, api_key=None, base_url=None, model_name=None, embedding_model=None):
-        self.vector_store = VectorStore(api_key, base_url, model_name, embedding_model)
+        self.vector_store = get_vector_store(api_key, base_url, model_name, embedding_model)
         
         # RRF 参数优化
         self.rrf_k = 60  # RRF 平滑参数
@@ -83,62 +93,74 @@ class HybridRetriever:
             processed_query, expanded_queries = self._optimize_query(query, domain)
             logger.info(f"优化后查询：{processed_query}, 扩展查询：{expanded_queries}")
 
-            all_results = []
-
-            for kb_id in kb_ids:
-                logger.info(f"开始检索知识库：{kb_id}")
-
-                # 检查知识库是否存在
-                try:
-                    collection = self.vector_store._get_collection(kb_id)
-                    collection_count = collection.count()
-                    logger.info(f"【重要】知识库 {kb_id} 中文档总数：{collection_count}")
-
-                    if collection_count == 0:
-                        logger.warning(f"【警告】知识库 {kb_id} 为空，跳过检索")
-                        continue
-
-                    # 获取部分文档示例
-                    if collection_count > 0:
-                        sample_docs = collection.get(limit=3)
-                        if sample_docs and sample_docs["documents"]:
-                            logger.info(f"【示例】知识库 {kb_id} 中的文档示例:")
-                            for i, doc in enumerate(sample_docs["documents"][:2]):
-                                logger.info(f"  文档 {i + 1}: {doc[:100]}...")
-
-                except Exception as e:
-                    logger.error(f"获取知识库 {kb_id} 失败：{e}")
-                    continue
-
-                if mode == "vector":
-                    results = await self._vector_search(processed_query, kb_id, strategy_top_k * 3, doc_ids)
-                elif mode == "keyword":
-                    results = self._keyword_search(processed_query, kb_id, strategy_top_k * 3, doc_ids)
-                else:
-                    # 混合检索：使用扩展查询增强
-                    if use_expanded_query:
-                        results = await self._enhanced_hybrid_search(
-                            processed_query, expanded_queries, kb_id, strategy_top_k * 2, v_weight, k_weight, doc_ids
-                        )
-                    else:
-                        results = await self._hybrid_search(
-                            processed_query, kb_id, strategy_top_k * 2, v_weight, k_weight, doc_ids
-                        )
-                all_results.extend(results)
-
-            # 按分数排序
-            all_results.sort(key=lambda x: x.score, reverse=True)
-
-            # 去重
-            seen = set()
-            unique_results = []
-            for r in all_results:
-                if r.chunk_id not in seen:
-                    seen.add(r.chunk_id)
-                    unique_results.append(r)
-
-            logger.info(f"检索到 {len(unique_results)} 个唯一结果")
-            return unique_results[:top_k]
+            # Step 2: 各知识库并发检索（受并发上限约束）
+            semaphore = asyncio.Semaphore(max(1, settings.RETRIEVAL_KB_CONCURRENCY))
+
+            async def search_kb(kb_id: str) -> List[RetrievalResult]:
+                async with semaphore:
+                    return await self._search_kb(
+                        kb_id, processed_query, expanded_queries, mode, strategy_top_k,
+                        v_weight, k_weight, use_expanded_query, doc_ids,
+                    )
+
+            # Step 3: 流式合并：每个知识库完成即并入，按 chunk_id 保留最高分，最后堆取 TopK
+            best: Dict[str, RetrievalResult] = {}
+            for finished in asyncio.as_completed([search_kb(kb_id) for kb_id in kb_ids]):
+                for r in await finished:
+                    current = best.get(r.chunk_id)
+                    if current is None or r.score > current.score:
+                        best[r.chunk_id] = r
+
+            logger.info(f"检索到 {len(best)} 个唯一结果")
+            return heapq.nlargest(top_k, best.values(), key=lambda x: x.score)
+
+    async def _search_kb(
+        self,
+        kb_id: str,
+        processed_query: str,
+        expanded_queries: List[str],
+        mode: str,
+        strategy_top_k: int,
+        v_weight: float,
+        k_weight: float,
+        use_expanded_query: bool,
+        doc_ids: Optional[List[str]] = None,
+    ) -> List[RetrievalResult]:
+        """单个知识库检索"""
+        logger.info(f"开始检索知识库：{kb_id}")
+
+        # 检查知识库是否为空 (文档数走缓存，不产生额外的 ChromaDB 调用)
+        try:
+            collection_count = self.vector_store.count(kb_id)
+            if collection_count == 0:
+                logger.warning(f"【警告】知识库 {kb_id} 为空，跳过检索")
+                return []
+
+            # 调试用：打印部分文档示例
+            if settings.LOG_RETRIEVAL_SAMPLES:
+                logger.info(f"【重要】知识库 {kb_id} 中文档总数：{collection_count}")
+                sample_docs = self.vector_store._get_collection(kb_id).get(limit=3)
+                if sample_docs and sample_docs["documents"]:
+                    logger.info(f"【示例】知识库 {kb_id} 中的文档示例:")
+                    for i, doc in enumerate(sample_docs["documents"][:2]):
+                        logger.info(f"  文档 {i + 1}: {doc[:100]}...")
+
+        except Exception as e:
+            logger.error(f"获取知识库 {kb_id} 失败：{e}")
+            return []
+
+        if mode == "vector":
+            return await self._vector_search(processed_query, kb_id, strategy_top_k * 3, doc_ids)
+        elif mode == "keyword":
+            return await self._keyword_search_async(processed_query, kb_id, strategy_top_k * 3, doc_ids)
+        # 混合检索：使用扩展查询增强
+        if use_expanded_query:
+            return await self._enhanced_hybrid_search(
+                processed_query, expanded_queries, kb_id, strategy_top_k * 2, v_weight, k_weight, doc_ids
+            )
+        return await self._hybrid_search(
+            processed_query, kb_id, strategy_top_k * 2, v_weight, k_weight, doc_ids
+        )
 
     def _optimize_query(self, query: str, domain: str = None) -> Tuple[str, List[str]]:
         """
@@ -232,17 +254,24 @@ class HybridRetriever:
         2. 扩展查询补充检索
         3. RRF 融合
         """
-        # 1. 主查询检索
-        vector_results = await self._vector_search(query, kb_id, top_k * 2, doc_ids)
-        keyword_results = self._keyword_search(query, kb_id, top_k * 2, doc_ids)
+        # 1. 主查询检索（两路并发）
+        vector_results, keyword_results = await asyncio.gather(
+            self._vector_search(query, kb_id, top_k * 2, doc_ids),
+            self._keyword_search_async(query, kb_id, top_k * 2, doc_ids),
+        )
 
-        # 2. 扩展查询补充（如果主查询结果少）
+        # 2. 扩展查询补充（如果主查询结果少），所有扩展查询并发执行
         if len(vector_results) < top_k or len(keyword_results) < top_k:
             logger.info("主查询结果不足，使用扩展查询补充")
-            for exp_query in expanded_queries[:2]:
-                exp_vector = await self._vector_search(exp_query, kb_id, top_k, doc_ids)
-                exp_keyword = self._keyword_search(exp_query, kb_id, top_k, doc_ids)
+            exp_queries = expanded_queries[:2]
+            exp_results = await asyncio.gather(
+                *[self._vector_search(q, kb_id, top_k, doc_ids) for q in exp_queries],
+                *[self._keyword_search_async(q, kb_id, top_k, doc_ids) for q in exp_queries],
+            )
+            # gather 保持提交顺序，与串行执行时的排名顺序一致
+            for exp_vector in exp_results[:len(exp_queries)]:
                 vector_results.extend(exp_vector)
+            for exp_keyword in exp_results[len(exp_queries):]:
                 keyword_results.extend(exp_keyword)
         
         # 去重
@@ -295,93 +324,53 @@ class HybridRetriever:
             for r in results
         ]
 
-    def _keyword_search(
+    async def _keyword_search_async(
             self, query: str, kb_id: str, top_k: int, doc_ids: Optional[List[str]] = None
     ) -> List[RetrievalResult]:
-        """BM25 关键词检索（优化版）"""
-        # 从向量库获取所有文档
-        collection = self.vector_store._get_collection(kb_id)
-        if collection.count() == 0:
-            return []
-
-        all_docs = collection.get(include=["documents", "metadatas"])
-        if not all_docs["documents"]:
-            return []
-
-        # ✅ 如果有 doc_ids 过滤，先过滤文档
-        if doc_ids:
-            filtered_docs = []
-            filtered_ids = []
-            filtered_metadatas = []
-
-            for i, doc_id in enumerate(all_docs["ids"]):
-                # 从 metadata 中获取 doc_id
-                meta = all_docs["metadatas"][i] if all_docs["metadatas"] else {}
-                meta_doc_id = meta.get("doc_id")
-
-                if meta_doc_id in doc_ids:
-                    filtered_docs.append(all_docs["documents"][i])
-                    filtered_ids.append(doc_id)
-                    filtered_metadatas.append(meta)
-
-            if not filtered_docs:
-                logger.info(f"文档 ID 过滤后无结果")
-                return []
-
-            all_docs["documents"] = filtered_docs
-            all_docs["ids"] = filtered_ids
-            all_docs["metadatas"] = filtered_metadatas
-            logger.info(f"文档 ID 过滤后剩余 {len(filtered_docs)} 个文档")
-
-        # 中文分词优化
-        tokenized_corpus = [
-            list(jieba.cut(doc)) for doc in all_docs["documents"]
-        ]
+        """在线程池中执行 BM25 检索"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _keyword_executor, self._keyword_search, query, kb_id, top_k, doc_ids
+        )
 
+    def _keyword_search(
+            self, query: str, kb_id: str, top_k: int, doc_ids: Optional[List[str]] = None
+    ) -> List[RetrievalResult]:
+        """BM25 关键词检索（基于持久化倒排索引）"""
         # 查询分词：添加关键词权重
-        query_words = list(jieba.cut(query))
+        query_words = tokenize(query)
         # 提取关键词并加权（重复出现）
         keywords = jieba.analyse.extract_tags(query, topK=10)
-        weighted_query = []
+        weighted_query = Counter()
         for word in query_words:
-            if word in keywords:
-                weighted_query.extend([word] * 3)
-            else:
-                weighted_query.append(word)
+            weighted_query[word] += 3 if word in keywords else 1
 
         # 增加音乐奖项相关术语的权重
         award_terms = ["金曲奖", "台湾金曲奖", "获奖", "奖项", "年度歌曲", "音乐录影带"]
         for term in award_terms:
             if term in query:
-                weighted_query.extend([term] * 2)
+                weighted_query[term] += 2
 
         # 增加歌手名称的权重
         artist_terms = ["周杰伦", "Jay Chou"]
         for term in artist_terms:
             if term in query:
-                weighted_query.extend([term] * 2)
+                weighted_query[term] += 2
 
-        # BM25
-        bm25 = BM25Okapi(tokenized_corpus)
-        scores = bm25.get_scores(weighted_query)
-
-        # 排序取 TopK
-        scored_docs = list(zip(
-            all_docs["ids"],
-            all_docs["documents"],
-            scores.tolist(),
-            all_docs["metadatas"] or [{}] * len(all_docs["ids"]),
-        ))
-        scored_docs.sort(key=lambda x: x[2], reverse=True)
+        # BM25：只读取查询词对应的 postings
+        scored_docs = self.vector_store.keyword_search(
+            kb_id, dict(weighted_query), top_k=top_k, doc_ids=doc_ids
+        )
+        if not scored_docs:
+            return []
 
-        max_score = max(scores) if len(scores) > 0 and max(scores) > 0 else 1.0
+        max_score = scored_docs[0].score if scored_docs[0].score > 0 else 1.0
 
         results = []
-        for doc_id, content, score, meta in scored_docs[:top_k]:
-            normalized_score = score / max_score if max_score > 0 else 0.0
+        for doc in scored_docs:
+            normalized_score = doc.score / max_score if max_score > 0 else 0.0
             # 检查内容是否包含关键术语
-            content_lower = content.lower()
-            query_lower = query.lower()
+            content_lower = doc.content.lower()
             # 如果内容包含查询中的关键术语，提高分数
             bonus = 0.0
             for keyword in keywords:
@@ -394,12 +383,12 @@ class HybridRetriever:
             normalized_score = min(1.0, normalized_score + bonus)
 
             results.append(RetrievalResult(
-                chunk_id=doc_id,
-                content=content,
+                chunk_id=doc.chunk_id,
+                content=doc.content,
                 score=normalized_score,
                 vector_score=0.0,
                 bm25_score=normalized_score,
-                metadata=meta or {},
+                metadata=doc.metadata or {},
             ))
 
         logger.info(f"BM25 检索到 {len(results)} 个结果，最高分：{max_score:.4f}")
@@ -415,12 +404,12 @@ class HybridRetriever:
         doc_ids: Optional[List[str]] = None,
     ) -> List[RetrievalResult]:
         """混合检索 + RRF 融合"""
-        # 两路召回
-        vector_results = await self._vector_search(query, kb_id, top_k * 2, doc_ids)
-        logger.info("vector_results 向量检索完成")
-        keyword_results = self._keyword_search(query, kb_id, top_k * 2, doc_ids)
-        logger.info("keywords 检索完成")
-        logger.info("两路召回向量检索完成")
+        # 两路召回（并发执行，耗时约为两路中的较大者）
+        vector_results, keyword_results = await asyncio.gather(
+            self._vector_search(query, kb_id, top_k * 2, doc_ids),
+            self._keyword_search_async(query, kb_id, top_k * 2, doc_ids),
+        )
+        logger.info("两路召回检索完成")
         # RRF 融合
         return self._rrf_fusion(
             vector_results,
@@ -2,14 +2,20 @@
 SmartRAG 向量存储 (ChromaDB)
 支持: 按知识库隔离的 Collection 管理
 """
+import time
+import asyncio
+import threading
+from collections import OrderedDict
 import chromadb
 from chromadb.config import Settings as ChromaSettings
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 from dataclasses import dataclass
 from loguru import logger
 
 from backend.app.config import get_settings
-from backend.app.core.embedder import EmbeddingService
+from backend.app.core.embedder import get_embedding_service, embedding_service_key
+from backend.app.core.bm25_index import get_bm25_index, drop_bm25_index, BM25Index
+from backend.app.core.embedding_store import get_embedding_store, content_hash
 
 settings = get_settings()
 
@@ -23,40 +29,63 @@ class SearchResult:
     metadata: dict
 
 
-class VectorStore:
-    """向量存储服务"""
+# ───────── 进程内共享的 ChromaDB 客户端与 Collection 元数据缓存 ─────────
+_chroma_client = None
+_chroma_lock = threading.Lock()
+# 句柄与文档数按知识库缓存，写入/删除时失效；所有 VectorStore 实例共享
+# 文档数缓存只在本进程内失效，其他进程 (或入库 worker) 的写入依赖 TTL 过期
+_collections: Dict[str, object] = {}
+_counts: Dict[str, Tuple[float, int]] = {}
+
+
+def get_chroma_client():
+    """获取共享的 ChromaDB 客户端 (惰性创建)"""
+    global _chroma_client
+    with _chroma_lock:
+        if _chroma_client is None:
+            _chroma_client = chromadb.PersistentClient(
+                path=settings.CHROMA_PERSIST_DIR,
+                settings=ChromaSettings(anonymized_telemetry=False),
+            )
+            logger.info("ChromaDB client initialized")
+        return _chroma_client
 
-    _instance = None
 
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialized = False
-        return cls._instance
+class VectorStore:
+    """向量存储服务 - 按 Embedding 模型区分实例，通过 get_vector_store 获取"""
 
     def __init__(self,api_key=None,base_url=None,model_name=None, embedding_model=None):
-        if self._initialized:
-            return
-        self._initialized = False
         logger.info(f"VectorStore初始化url:{base_url}, model:{model_name}, embedding_model:{embedding_model}")
-        # if api_key is None or base_url is None or model_name is None and embedding_model is None:
-        #     logger.error("VectorStore初始化失败, api_key, base_url, model_name, embedding_model 模型参数为空")
-        #     logger.info("无需初始化VectorStore")
-        # else:
-        self.client = chromadb.PersistentClient(
-            path=settings.CHROMA_PERSIST_DIR,
-            settings=ChromaSettings(anonymized_telemetry=False),
-        )
-        self.embedder = EmbeddingService(embedding_model=embedding_model)
+        self.client = get_chroma_client()
+        self.embedder = get_embedding_service(api_key, base_url, model_name, embedding_model)
         logger.info("VectorStore initialized (ChromaDB)")
 
     def _get_collection(self, kb_id: str):
-        """获取或创建 Collection"""
-        collection_name = f"kb_{kb_id.replace('-', '_')}"
-        return self.client.get_or_create_collection(
-            name=collection_name,
-            metadata={"hnsw:space": "cosine"},
-        )
+        """获取或创建 Collection (句柄按知识库缓存)"""
+        collection = _collections.get(kb_id)
+        if collection is None:
+            collection_name = f"kb_{kb_id.replace('-', '_')}"
+            collection = self.client.get_or_create_collection(
+                name=collection_name,
+                metadata={"hnsw:space": "cosine"},
+            )
+            _collections[kb_id] = collection
+        return collection
+
+    def count(self, kb_id: str) -> int:
+        """Collection 文档数 (缓存，0 不缓存：空知识库随时可能被其他进程写入)"""
+        cached = _counts.get(kb_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        count = self._get_collection(kb_id).count()
+        if count:
+            _counts[kb_id] = (time.monotonic() + settings.COLLECTION_COUNT_CACHE_TTL, count)
+        else:
+            _counts.pop(kb_id, None)
+        return count
+
+    def _invalidate_count(self, kb_id: str):
+        _counts.pop(kb_id, None)
 
     async def add_chunks(
         self,
@@ -64,15 +93,39 @@ class VectorStore:
         chunk_ids: List[str],
         contents: List[str],
         metadatas: List[dict],
+        tokens: Optional[List[List[str]]] = None,
     ):
-        """批量添加向量"""
+        """
+        批量添加向量 (向量化 + 写入)
+        tokens: 入库时预先计算的 BM25 分词结果，提供时不再重复分词
+        """
         if not contents:
             return
 
-        collection = self._get_collection(kb_id)
+        # 批量 Embedding (优先复用已存储的相同文本向量)
+        embeddings = await self.embed_contents(contents)
+        await asyncio.to_thread(
+            self.write_chunks, kb_id, chunk_ids, contents, metadatas, embeddings, tokens
+        )
 
-        # 批量 Embedding
-        embeddings = await self.embedder.embed_texts(contents)
+    async def embed_contents(self, contents: List[str]) -> List[List[float]]:
+        """分块向量化 (入库流水线的 embedding 阶段)"""
+        return await self._embed_with_store(contents)
+
+    def write_chunks(
+        self,
+        kb_id: str,
+        chunk_ids: List[str],
+        contents: List[str],
+        metadatas: List[dict],
+        embeddings: List[List[float]],
+        tokens: Optional[List[List[str]]] = None,
+    ):
+        """写入已向量化的分块: ChromaDB + BM25 倒排索引 (同步，入库流水线的存储阶段)"""
+        if not contents:
+            return
+
+        collection = self._get_collection(kb_id)
 
         # 写入 ChromaDB
         batch_size = 500
@@ -84,11 +137,46 @@ class VectorStore:
                 documents=contents[i:end],
                 metadatas=metadatas[i:end],
             )
+        self._invalidate_count(kb_id)
+
+        # 增量更新 BM25 倒排索引
+        get_bm25_index(kb_id).add(
+            chunk_ids=chunk_ids,
+            doc_ids=[(m or {}).get("doc_id") for m in metadatas],
+            contents=contents,
+            tokens=tokens,
+        )
 
         logger.info(
             f"Added {len(contents)} chunks to collection kb_{kb_id}"
         )
 
+    async def _embed_with_store(self, contents: List[str]) -> List[List[float]]:
+        """按 (模型, 文本哈希) 查询持久化向量，只为未命中的文本调用 Embedding API"""
+        store = get_embedding_store()
+        model_key = self.embedder.model_key
+        hashes = [content_hash(c) for c in contents]
+
+        known = await asyncio.to_thread(store.get_many, model_key, hashes)
+
+        # 未命中的文本去重后再请求
+        missing: Dict[str, str] = {}
+        for h, text in zip(hashes, contents):
+            if h not in known and h not in missing:
+                missing[h] = text
+
+        if missing:
+            new_embeddings = await self.embedder.embed_texts(list(missing.values()))
+            fresh = dict(zip(missing.keys(), new_embeddings))
+            await asyncio.to_thread(store.put_many, model_key, fresh)
+            known.update(fresh)
+
+        logger.info(
+            f"Embedding store: {len(contents)} chunks, {len(contents) - len(missing)} reused, "
+            f"{len(missing)} embedded"
+        )
+        return [known[h] for h in hashes]
+
     async def search(
         self,
         kb_id: str,
@@ -96,11 +184,11 @@ class VectorStore:
         top_k: int = 20,
         doc_ids: Optional[List[str]] = None,
     ) -> List[SearchResult]:
-        """向量检索"""
-        collection = self._get_collection(kb_id)
-
-        if collection.count() == 0:
+        """向量检索 (每次检索只访问一次 ChromaDB)"""
+        collection_count = self.count(kb_id)
+        if collection_count == 0:
             return []
+        collection = self._get_collection(kb_id)
 
         # 构建 where 条件
         where_clause = None
@@ -111,11 +199,13 @@ class VectorStore:
         query_embedding = await self.embedder.embed_query(query)
         logger.info(f"query_embedding完成")
 
-        results = collection.query(
+        # ChromaDB 查询为同步调用，放到线程中执行，不阻塞事件循环
+        results = await asyncio.to_thread(
+            collection.query,
             query_embeddings=[query_embedding],
-            n_results=min(top_k, collection.count()),
+            n_results=min(top_k, collection_count),
             include=["documents", "metadatas", "distances"],
-            where = where_clause,
+            where=where_clause,
         )
 
         search_results = []
@@ -135,6 +225,61 @@ class VectorStore:
 
         return search_results
 
+    def _get_keyword_index(self, kb_id: str) -> BM25Index:
+        """
+        获取 BM25 索引，首次使用时从 Collection 回填存量分块
+        以索引中的回填标记为准，不能依赖索引是否为空：旧知识库上线后新上传的文档会先写入索引
+        """
+        index = get_bm25_index(kb_id)
+        if not index.backfilled:
+            if self.count(kb_id) > 0:
+                logger.info(f"Building BM25 index for existing collection kb_{kb_id}")
+                all_docs = self._get_collection(kb_id).get(include=["documents", "metadatas"])
+                metadatas = all_docs["metadatas"] or [{}] * len(all_docs["ids"])
+                # add 按 chunk_id 覆盖写入，已在索引中的分块不会重复计数
+                index.add(
+                    chunk_ids=all_docs["ids"],
+                    doc_ids=[(m or {}).get("doc_id") for m in metadatas],
+                    contents=all_docs["documents"],
+                )
+            index.mark_backfilled()
+        return index
+
+    def keyword_search(
+        self,
+        kb_id: str,
+        query_terms: Dict[str, float],
+        top_k: int = 20,
+        doc_ids: Optional[List[str]] = None,
+    ) -> List[SearchResult]:
+        """BM25 关键词检索 (score 为原始 BM25 分数)"""
+        hits = self._get_keyword_index(kb_id).search(query_terms, top_k, doc_ids)
+        if not hits:
+            return []
+
+        collection = self._get_collection(kb_id)
+        docs = collection.get(
+            ids=[chunk_id for chunk_id, _ in hits],
+            include=["documents", "metadatas"],
+        )
+        by_id = {}
+        for i, chunk_id in enumerate(docs["ids"]):
+            by_id[chunk_id] = (
+                docs["documents"][i],
+                docs["metadatas"][i] if docs["metadatas"] else {},
+            )
+
+        return [
+            SearchResult(
+                chunk_id=chunk_id,
+                content=by_id[chunk_id][0],
+                score=score,
+                metadata=by_id[chunk_id][1] or {},
+            )
+            for chunk_id, score in hits
+            if chunk_id in by_id
+        ]
+
     def delete_by_doc(self, kb_id: str, doc_id: str):
         """删除某个文档的所有向量"""
         collection = self._get_collection(kb_id)
@@ -143,20 +288,49 @@ class VectorStore:
             logger.info(f"Deleted vectors for doc {doc_id}")
         except Exception as e:
             logger.error(f"Failed to delete vectors: {e}")
+        self._invalidate_count(kb_id)
+        try:
+            get_bm25_index(kb_id).delete_by_doc(doc_id)
+        except Exception as e:
+            logger.error(f"Failed to delete BM25 postings: {e}")
 
     def delete_collection(self, kb_id: str):
         """删除整个知识库的 Collection"""
         collection_name = f"kb_{kb_id.replace('-', '_')}"
+        _collections.pop(kb_id, None)
+        self._invalidate_count(kb_id)
         try:
             self.client.delete_collection(collection_name)
             logger.info(f"Deleted collection {collection_name}")
         except Exception as e:
             logger.warning(f"Collection not found: {e}")
+        drop_bm25_index(kb_id)
 
     def get_collection_stats(self, kb_id: str) -> dict:
         """获取 Collection 统计信息"""
         collection = self._get_collection(kb_id)
         return {
-            "count": collection.count(),
+            "count": self.count(kb_id),
             "name": collection.name,
-        }
\ No newline at end of file
+        }
+
+
+# ───────── 按模型复用的 VectorStore 注册表 ─────────
+_stores: "OrderedDict[tuple, VectorStore]" = OrderedDict()
+
+
+def get_vector_store(api_key=None, base_url=None, model_name=None, embedding_model=None) -> VectorStore:
+    """按 Embedding 模型获取 (惰性创建) VectorStore，与 EmbeddingService 注册表同步淘汰"""
+    key = embedding_service_key(api_key, base_url, model_name, embedding_model)
+    store = _stores.get(key)
+    if store is not None:
+        _stores.move_to_end(key)
+        # 确保使用注册表中当前的 EmbeddingService 实例
+        store.embedder = get_embedding_service(api_key, base_url, model_name, embedding_model)
+        return store
+
+    store = VectorStore(api_key, base_url, model_name, embedding_model)
+    _stores[key] = store
+    while len(_stores) > settings.EMBEDDING_SERVICE_CACHE_SIZE:
+        _stores.popitem(last=False)
+    return store
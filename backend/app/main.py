@@ -1,16 +1,40 @@
 # main.py
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 import uvicorn
 # 导入app模块以初始化loguru配置
 import backend.app
 from backend.app.api.router import api_router  # 引入已定义的路由
 from backend.app.database import init_db, init_pm_db  # 引入数据库初始化函数
+from backend.app.services.ingestion_service import ingestion_pool  # 文档入库后台任务
+from backend.app.core.parse_worker import shutdown_parse_pool
+from backend.app.config import get_settings
+
+settings = get_settings()
+# multipart 表单中除文件内容外的边界 / 字段头等开销
+UPLOAD_FORM_OVERHEAD = 64 * 1024
 # 创建 FastAPI 应用实例
 app = FastAPI()
 
 # 注册所有 API 路由
 app.include_router(api_router)
 
+
+# 上传大小预检：按 Content-Length 在解析表单前拒绝超限请求
+# (FastAPI 会在执行接口和依赖之前把整个 multipart 请求体落到临时文件)
+# 未声明 Content-Length 的分块传输请求仍由上传接口在写盘时校验
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    content_type = request.headers.get("content-type", "")
+    content_length = request.headers.get("content-length")
+    if content_type.startswith("multipart/form-data") and content_length and content_length.isdigit():
+        if int(content_length) > settings.MAX_FILE_SIZE_MB * 1024 * 1024 + UPLOAD_FORM_OVERHEAD:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"文件大小超过限制: {settings.MAX_FILE_SIZE_MB}MB"},
+            )
+    return await call_next(request)
+
 # 根路径示例（可选）
 @app.get("/")
 def read_root():
@@ -21,6 +45,13 @@ def read_root():
 async def startup_event():
     await init_db()
     await init_pm_db()
+    await ingestion_pool.start()
+
+# 关闭事件：停止入库 worker
+@app.on_event("shutdown")
+async def shutdown_event():
+    await ingestion_pool.stop()
+    shutdown_parse_pool()
 
 # 可选：内嵌启动逻辑
 if __name__ == "__main__":
@@ -1,6 +1,6 @@
 from backend.app.models.user import User
 from backend.app.models.knowledge_base import KnowledgeBase
-from backend.app.models.document import Document, DocumentChunk
+from backend.app.models.document import Document, DocumentChunk, IngestionJob
 from backend.app.models.conversation import Conversation, Message, Feedback, ChatLog
 from backend.app.models.evaluation import Evaluation
 from backend.app.models.model import Model, ModelType
@@ -13,6 +13,7 @@ __all__ = [
     "KnowledgeBase",
     "Document",
     "DocumentChunk",
+    "IngestionJob",
     "Conversation",
     "Message",
     "Feedback",
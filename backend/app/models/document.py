@@ -75,4 +75,35 @@ class DocumentChunk(Base):
     )
 
     # 关系
-    document = relationship("Document", back_populates="chunks")
\ No newline at end of file
+    document = relationship("Document", back_populates="chunks")
+
+
+class IngestionJob(Base):
+    """文档入库任务 (解析 → 分块 → 向量化 → 存储)，由后台 worker 执行"""
+    __tablename__ = "kb_ingestion_jobs"
+
+    id: Mapped[str] = mapped_column(
+        String(36), primary_key=True, default=lambda: str(uuid.uuid4())
+    )
+    doc_id: Mapped[str] = mapped_column(
+        String(36), ForeignKey("kb_documents.id"), index=True
+    )
+    kb_id: Mapped[str] = mapped_column(String(36), index=True)
+    status: Mapped[str] = mapped_column(
+        String(20), default="queued", index=True
+    )  # queued / running / completed / failed / cancelled
+    stage: Mapped[str] = mapped_column(String(20), nullable=True)  # parsing / embedding / storing
+    progress: Mapped[int] = mapped_column(Integer, default=0)  # 0 - 100
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    worker: Mapped[str] = mapped_column(String(100), nullable=True)  # 认领任务的 worker 标识
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)  # 执行中定期刷新，超时视为 worker 已退出
+    error_msg: Mapped[str] = mapped_column(Text, nullable=True)
+    metrics: Mapped[dict] = mapped_column(JSON, nullable=True)  # 各阶段吞吐统计
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow
+    )
+    started_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
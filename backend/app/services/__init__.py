@@ -1,6 +1,7 @@
 from backend.app.services.chat_service import chat
 from backend.app.services.kb_service import KnowledgeBaseService, kb_service
 from backend.app.services.doc_service import process_document
+from backend.app.services.ingestion_service import IngestionWorkerPool, ingestion_pool
 from backend.app.services.system_service import SystemService
 from backend.app.services.user_service import UserService, user_service
 
@@ -9,6 +10,8 @@ __all__ = [
     "KnowledgeBaseService",
     "kb_service",
     "process_document",
+    "IngestionWorkerPool",
+    "ingestion_pool",
     "SystemService",
     "UserService",
     "user_service"
@@ -2,38 +2,119 @@
 文档上传 & 处理服务
 """
 import os
+import time
 import uuid
-from typing import Optional
+import asyncio
+from dataclasses import dataclass
+from typing import Optional, Callable, Awaitable, Dict
 from loguru import logger
-from sqlalchemy import select, update
+from sqlalchemy import select, update, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from backend.app.config import get_settings
 from backend.app.models.document import Document, DocumentChunk
 from backend.app.models.knowledge_base import KnowledgeBase
-from backend.app.core.document_parser import DocumentParser
-from backend.app.core.chunker import SmartChunker
-from backend.app.core.vector_store import VectorStore
+from backend.app.core.parse_worker import stream_parse_and_chunk
+from backend.app.core.vector_store import get_vector_store
+from backend.app.core.bm25_index import tokenize
+from backend.app.core.answer_cache import answer_cache
 
 settings = get_settings()
-parser = DocumentParser()
-chunker = SmartChunker()
 
-# 延迟初始化VectorStore，在process_document中根据知识库配置创建
-vector_store_instances = {}
+# 进度回调: (阶段, 进度百分比)
+ProgressCallback = Callable[[str, int], Awaitable[None]]
+
+
+@dataclass
+class StageMetrics:
+    """入库流水线单个阶段的吞吐统计"""
+    name: str
+    batches: int = 0
+    chunks: int = 0
+    busy_seconds: float = 0.0  # 阶段实际工作时间 (不含等待上下游队列)
+
+    def record(self, chunks: int, seconds: float):
+        self.batches += 1
+        self.chunks += chunks
+        self.busy_seconds += seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "batches": self.batches,
+            "chunks": self.chunks,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "chunks_per_second": round(self.chunks / self.busy_seconds, 1) if self.busy_seconds else None,
+        }
+
+
+class DocumentDeletedError(Exception):
+    """处理过程中文档已被删除"""
+
+
+async def ensure_not_deleted(db: AsyncSession, doc_id: str, lock: bool = False):
+    """
+    重新读取文档的删除标记 (处理期间文档可能被删除)，已删除时抛出 DocumentDeletedError
+    lock=True 时锁定文档行 (FOR NO KEY UPDATE)，与删除接口的行锁互斥，提交前的最后一次检查不会与删除交错
+    """
+    stmt = select(Document.is_deleted).where(Document.id == doc_id)
+    if lock:
+        stmt = stmt.with_for_update(key_share=True)
+    if (await db.execute(stmt)).scalar_one_or_none() is not False:
+        raise DocumentDeletedError(f"文档已删除: {doc_id}")
+
+
+def _tokenize_all(chunks) -> list:
+    return [tokenize(c.content) for c in chunks]
+
+
+async def to_thread_uncancelled(func, *args):
+    """
+    在线程中执行写操作: 被取消时仍等待线程执行结束再抛出 CancelledError
+    (线程无法中止，直接放弃等待的话写入可能落在失败清理之后)
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.gather(future, return_exceptions=True)
+        raise
+
+
+async def run_stages(*stages: Awaitable[None]):
+    """
+    并发运行流水线各阶段，任一阶段失败时取消其余阶段并抛出异常
+    抛出前等待所有阶段 (包括执行中的线程写入) 结束，调用方随后的清理不会与写入交错
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 async def process_document(
     db: AsyncSession,
     doc_id: str,
-):
+    progress: Optional[ProgressCallback] = None,
+) -> Optional[Dict[str, dict]]:
     """
     文档处理全流程:
     1. 解析文档
     2. 智能分块
     3. 向量化 & 存入向量库
     4. 更新数据库状态
+    progress: 可选的进度回调，由后台入库任务用来上报阶段和进度
+    返回: 各阶段吞吐统计 {"chunk": {...}, "embed": {...}, "store": {...}}
     """
+    async def report(stage: str, percent: int):
+        if progress is not None:
+            await progress(stage, percent)
+
     # 获取文档记录
     result = await db.execute(select(Document).where(Document.id == doc_id))
     doc = result.scalar_one_or_none()
@@ -41,6 +122,9 @@ async def process_document(
         logger.error(f"Document not found: {doc_id}")
         return
 
+    # 重新处理 (重试 / 重建索引) 时，知识库统计按与上次结果的差值更新
+    previous_chunk_count = doc.chunk_count or 0
+
     try:
         # 更新状态
         doc.status = "processing"
@@ -48,11 +132,6 @@ async def process_document(
 
         logger.info(f"Processing document: {doc.filename}")
 
-        # Step 1: 解析
-        parsed = parser.parse(doc.file_path)
-        if not parsed.content.strip():
-            raise ValueError("文档内容为空")
-
         # 获取知识库的分块方式设置
         kb_result = await db.execute(
             select(KnowledgeBase).where(KnowledgeBase.id == doc.kb_id)
@@ -62,51 +141,6 @@ async def process_document(
             raise ValueError(f"知识库不存在: {doc.kb_id}")
         chunk_method = kb.chunk_method if kb else "smart"
 
-        # Step 2: 分块
-        chunks = chunker.chunk_document(parsed, doc.id, doc.kb_id, chunk_method)
-        if not chunks:
-            raise ValueError("分块结果为空")
-
-        # Step 3: 存入数据库
-        db_chunks = []
-        chunk_ids = []
-        chunk_contents = []
-        chunk_metadatas = []
-
-        for chunk in chunks:
-            # 添加知识库名称到元数据
-            chunk.metadata["kb_name"] = kb.name
-            
-            db_chunk = DocumentChunk(
-                id=chunk.id,
-                doc_id=doc.id,
-                kb_id=doc.kb_id,
-                content=chunk.content,
-                chunk_index=chunk.chunk_index,
-                token_count=chunk.token_count,
-                meta=chunk.metadata,
-            )
-            db_chunks.append(db_chunk)
-            chunk_ids.append(chunk.id)
-            chunk_contents.append(chunk.content)
-            chunk_metadatas.append(chunk.metadata)
-
-        db.add_all(db_chunks)
-
-        # Step 4: 向量化 & 存入向量库
-        # 获取知识库配置
-        kb_result = await db.execute(
-            select(KnowledgeBase).where(KnowledgeBase.id == doc.kb_id)
-        )
-        kb = kb_result.scalar_one_or_none()
-        
-        if not kb:
-            raise ValueError(f"知识库不存在: {doc.kb_id}")
-        
-        # 更新分块的元数据，添加知识库名称
-        for i, chunk in enumerate(chunk_metadatas):
-            chunk["kb_name"] = kb.name
-        
         # 获取模型配置
         embedding_model_id = kb.embedding_model_id
         embedding_model = None
@@ -116,47 +150,140 @@ async def process_document(
                 select(Model).where(Model.id == embedding_model_id)
             )
             embedding_model = model_result.scalar_one_or_none()
-        
-        # 创建或获取VectorStore实例
-        vector_store_key = f"{doc.kb_id}_{embedding_model_id or 'default'}"
-        if vector_store_key not in vector_store_instances:
-            vector_store_instances[vector_store_key] = VectorStore(embedding_model=embedding_model)
-        
-        current_vector_store = vector_store_instances[vector_store_key]
-        
-        # 向量化并存储
-        await current_vector_store.add_chunks(
-            kb_id=doc.kb_id,
-            chunk_ids=chunk_ids,
-            contents=chunk_contents,
-            metadatas=chunk_metadatas,
+
+        # 按 Embedding 模型获取VectorStore实例
+        current_vector_store = get_vector_store(embedding_model=embedding_model)
+
+        # 重新处理时先软删除上一次的分块记录，与本次写入同一事务，失败回滚后旧记录恢复
+        await db.execute(
+            update(DocumentChunk)
+            .where(DocumentChunk.doc_id == doc.id, DocumentChunk.is_deleted == False)
+            .values(is_deleted=True)
         )
 
+        # 分阶段流水线: 解析分块 → 向量化 → 存储，阶段之间用有界队列衔接，
+        # 第 N 批向量化的同时写入第 N-1 批、解析第 N+1 批，内存只与批大小和队列长度相关
+        await report("parsing", 10)
+        metrics = {name: StageMetrics(name) for name in ("chunk", "embed", "store")}
+        embed_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.INGESTION_QUEUE_SIZE)
+        store_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.INGESTION_QUEUE_SIZE)
+        total_chunks = 0
+
+        async def chunk_stage():
+            batches = stream_parse_and_chunk(
+                doc.file_path, doc.id, doc.kb_id, chunk_method,
+                batch_size=settings.INGESTION_BATCH_SIZE,
+            )
+            try:
+                while True:
+                    started = time.monotonic()
+                    chunks = await anext(batches, None)
+                    if chunks is None:
+                        break
+                    for chunk in chunks:
+                        # 添加知识库名称到元数据
+                        chunk.metadata["kb_name"] = kb.name
+                    # BM25 分词只在入库时做一次，随分块写入倒排索引
+                    tokens = await asyncio.to_thread(_tokenize_all, chunks)
+                    metrics["chunk"].record(len(chunks), time.monotonic() - started)
+                    await embed_queue.put((chunks, tokens))
+            finally:
+                await batches.aclose()
+            await embed_queue.put(None)
+
+        async def embed_stage():
+            reported = False
+            while True:
+                item = await embed_queue.get()
+                if item is None:
+                    break
+                chunks, tokens = item
+                if not reported:
+                    await report("embedding", 50)
+                    reported = True
+                started = time.monotonic()
+                embeddings = await current_vector_store.embed_contents([c.content for c in chunks])
+                metrics["embed"].record(len(chunks), time.monotonic() - started)
+                await store_queue.put((chunks, tokens, embeddings))
+            await store_queue.put(None)
+
+        async def store_stage():
+            nonlocal total_chunks
+            while True:
+                item = await store_queue.get()
+                if item is None:
+                    break
+                chunks, tokens, embeddings = item
+                # 文档已被删除时不再写入向量 / 倒排索引
+                await ensure_not_deleted(db, doc.id)
+                started = time.monotonic()
+                # 整批一条 INSERT 写入，不创建 ORM 对象
+                await db.execute(insert(DocumentChunk).values([
+                    {
+                        "id": chunk.id,
+                        "doc_id": doc.id,
+                        "kb_id": doc.kb_id,
+                        "content": chunk.content,
+                        "chunk_index": chunk.chunk_index,
+                        "token_count": chunk.token_count,
+                        "meta": chunk.metadata,
+                    }
+                    for chunk in chunks
+                ]))
+                await to_thread_uncancelled(
+                    current_vector_store.write_chunks,
+                    doc.kb_id,
+                    [c.id for c in chunks],
+                    [c.content for c in chunks],
+                    [c.metadata for c in chunks],
+                    embeddings,
+                    tokens,
+                )
+                metrics["store"].record(len(chunks), time.monotonic() - started)
+                total_chunks += len(chunks)
+
+        await run_stages(chunk_stage(), embed_stage(), store_stage())
+        stage_metrics = {name: m.to_dict() for name, m in metrics.items()}
+        logger.info(f"Ingestion pipeline metrics for '{doc.filename}': {stage_metrics}")
+
+        if not total_chunks:
+            raise ValueError("文档内容为空")
+
+        # 提交前锁定文档行再检查一次，处理期间被删除的文档不再计入统计
+        await ensure_not_deleted(db, doc.id, lock=True)
+
         # Step 5: 更新统计
+        await report("storing", 90)
         doc.status = "completed"
-        doc.chunk_count = len(chunks)
+        doc.chunk_count = total_chunks
 
-        # 更新知识库统计
-        kb_result = await db.execute(
-            select(KnowledgeBase).where(KnowledgeBase.id == doc.kb_id)
-        )
-        kb = kb_result.scalar_one_or_none()
-        if kb:
-            # 重新计算，只统计未删除的文档
-            count_result = await db.execute(
-                select(Document).where(Document.kb_id == doc.kb_id, Document.is_deleted == False)
+        # 更新知识库统计: 原子增量更新，不再重新加载知识库下的全部文档
+        await db.execute(
+            update(KnowledgeBase)
+            .where(KnowledgeBase.id == doc.kb_id)
+            .values(
+                doc_count=KnowledgeBase.doc_count + (0 if previous_chunk_count else 1),
+                chunk_count=KnowledgeBase.chunk_count + total_chunks - previous_chunk_count,
             )
-            all_docs = count_result.scalars().all()
-            kb.doc_count = len(all_docs)
-            kb.chunk_count = sum(d.chunk_count for d in all_docs)
+        )
 
         await db.commit()
+        # 知识库内容已变化，相关的问答缓存失效
+        await answer_cache.invalidate_kb(doc.kb_id)
         logger.info(
-            f"Document '{doc.filename}' processed: {len(chunks)} chunks"
+            f"Document '{doc.filename}' processed: {total_chunks} chunks"
         )
+        return stage_metrics
 
     except Exception as e:
         logger.error(f"Document processing failed: {e}")
+        # 分批写入的向量 / 倒排索引不受数据库事务保护，失败时清理已写入的部分
+        try:
+            await asyncio.to_thread(get_vector_store().delete_by_doc, doc.kb_id, doc.id)
+        except Exception as cleanup_error:
+            logger.warning(f"Failed to clean up partial vectors of {doc.id}: {cleanup_error}")
+        # 向量已被删除 (可能还有上一次处理的结果)，无论成功与否都使问答缓存失效
+        await answer_cache.invalidate_kb(doc.kb_id)
         # 不要在这里提交事务，让调用者处理事务回滚
         # 文档记录和分块记录会被自动回滚
         raise
\ No newline at end of file
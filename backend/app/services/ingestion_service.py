@@ -0,0 +1,275 @@
+"""
+文档入库后台任务服务
+- 上传接口只负责落盘 + 建任务，解析 / 分块 / 向量化由后台 worker 完成
+- 任务状态持久化在 kb_ingestion_jobs 表，多个进程共享同一张任务表
+- worker 通过条件更新认领任务 (queued → running)，同一任务只会被一个进程执行
+- 执行中定期刷新心跳，租约过期的 running 任务 (进程已退出) 会被重新排队
+- 失败任务可通过重试接口重新入队
+"""
+import os
+import uuid
+import socket
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Optional, Set
+from loguru import logger
+from sqlalchemy import select, update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.app.config import get_settings
+from backend.app.database import async_session_factory
+from backend.app.models.document import Document, IngestionJob
+from backend.app.core.vector_store import get_vector_store
+from backend.app.core.answer_cache import answer_cache
+from backend.app.services.doc_service import process_document, DocumentDeletedError
+
+settings = get_settings()
+
+
+async def create_job(db: AsyncSession, doc: Document) -> IngestionJob:
+    """为文档创建入库任务 (由调用方提交事务后再调用 ingestion_pool.submit)"""
+    job = IngestionJob(doc_id=doc.id, kb_id=doc.kb_id, status="queued", progress=0)
+    db.add(job)
+    await db.flush()
+    return job
+
+
+async def get_latest_job(db: AsyncSession, doc_id: str) -> Optional[IngestionJob]:
+    """获取文档最近一次的入库任务"""
+    result = await db.execute(
+        select(IngestionJob)
+        .where(IngestionJob.doc_id == doc_id)
+        .order_by(IngestionJob.created_at.desc())
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
+class IngestionWorkerPool:
+    """入库任务 worker 池 (进程内 asyncio 队列，任务状态与归属以数据库为准)"""
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[str] = set()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self):
+        """启动 worker 和定期扫描任务 (接管租约过期的任务、拉取其他进程未执行的任务)"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._queued = set()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+        self._tasks.append(asyncio.create_task(self._poll_loop()))
+        logger.info(f"Ingestion workers started: {self.workers} workers, worker_id={self.worker_id}")
+
+    async def stop(self):
+        """停止 worker (执行中的任务保持 running，租约过期后由其他进程或下次启动接管)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued = set()
+        logger.info("Ingestion workers stopped")
+
+    def submit(self, job_id: str):
+        """任务入队 (任务记录需已提交到数据库；实际执行前还要在数据库中认领)"""
+        if self._queue is None:
+            logger.warning(f"Ingestion workers not running, job {job_id} will be picked up by the next poll")
+            return
+        if job_id in self._queued:
+            return
+        self._queued.add(job_id)
+        self._queue.put_nowait(job_id)
+
+    async def _poll_loop(self):
+        while True:
+            try:
+                await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ingestion job poll failed: {e}")
+            await asyncio.sleep(settings.INGESTION_POLL_INTERVAL)
+
+    async def _poll(self):
+        """租约过期的 running 任务重新排队，并把待执行的任务放入本地队列"""
+        expired_before = datetime.utcnow() - timedelta(seconds=settings.INGESTION_JOB_LEASE)
+        async with async_session_factory() as db:
+            result = await db.execute(
+                update(IngestionJob)
+                .where(
+                    IngestionJob.status == "running",
+                    # 没有心跳记录的是旧版本遗留的 running 任务
+                    or_(IngestionJob.heartbeat_at < expired_before, IngestionJob.heartbeat_at.is_(None)),
+                )
+                .values(status="queued", worker=None)
+            )
+            if result.rowcount:
+                logger.warning(f"Requeued {result.rowcount} ingestion jobs with expired lease")
+            await db.commit()
+
+            result = await db.execute(
+                select(IngestionJob.id)
+                .where(IngestionJob.status == "queued")
+                .order_by(IngestionJob.created_at)
+            )
+            pending = result.scalars().all()
+
+        for job_id in pending:
+            self.submit(job_id)
+
+    async def _worker(self, index: int):
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self._run_job(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ingestion worker {index} failed on job {job_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _claim(self, job_id: str) -> bool:
+        """认领任务: 只有 queued 状态的任务能被一个 worker 改为 running"""
+        now = datetime.utcnow()
+        async with async_session_factory() as db:
+            result = await db.execute(
+                update(IngestionJob)
+                .where(IngestionJob.id == job_id, IngestionJob.status == "queued")
+                .values(
+                    status="running",
+                    worker=self.worker_id,
+                    heartbeat_at=now,
+                    started_at=now,
+                    stage=None,
+                    progress=0,
+                    attempts=IngestionJob.attempts + 1,
+                    error_msg=None,
+                )
+            )
+            await db.commit()
+            return result.rowcount == 1
+
+    def _owned(self, job_id: str):
+        """
+        只更新仍归本 worker 所有且执行中的任务
+        (租约过期被接管、或文档删除时任务被取消后，不再覆盖其状态)
+        """
+        return update(IngestionJob).where(
+            IngestionJob.id == job_id,
+            IngestionJob.worker == self.worker_id,
+            IngestionJob.status == "running",
+        )
+
+    async def _heartbeat(self, job_id: str):
+        interval = max(1, settings.INGESTION_JOB_LEASE // 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with async_session_factory() as db:
+                    await db.execute(self._owned(job_id).values(heartbeat_at=datetime.utcnow()))
+                    await db.commit()
+            except Exception as e:
+                logger.warning(f"Ingestion job {job_id} heartbeat failed: {e}")
+
+    async def _report(self, job_id: str, stage: str, percent: int):
+        """上报任务进度 (独立的短事务，不影响文档处理事务)"""
+        async with async_session_factory() as db:
+            now = datetime.utcnow()
+            await db.execute(
+                self._owned(job_id).values(
+                    stage=stage, progress=percent, updated_at=now, heartbeat_at=now
+                )
+            )
+            await db.commit()
+
+    async def _run_job(self, job_id: str):
+        if not await self._claim(job_id):
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            await self._execute(job_id)
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _execute(self, job_id: str):
+        async with async_session_factory() as db:
+            job = await db.get(IngestionJob, job_id)
+            doc = await db.get(Document, job.doc_id)
+            if not doc or doc.is_deleted:
+                await db.execute(
+                    self._owned(job_id).values(status="cancelled", finished_at=datetime.utcnow())
+                )
+                await db.commit()
+                return
+
+            doc.status = "processing"
+            doc.error_msg = None
+            await db.commit()
+
+            # 回滚后 ORM 对象会过期，提前取出需要的字段
+            doc_id, kb_id = job.doc_id, job.kb_id
+            logger.info(f"Ingestion job {job_id} started: doc={doc.filename}, attempt={job.attempts}")
+
+            async def progress(stage: str, percent: int):
+                await self._report(job_id, stage, percent)
+
+            try:
+                # 清理上一次失败尝试可能残留的向量 / 倒排索引数据
+                await asyncio.to_thread(get_vector_store().delete_by_doc, kb_id, doc_id)
+                await answer_cache.invalidate_kb(kb_id)
+                metrics = await process_document(db, doc_id, progress=progress)
+            except DocumentDeletedError:
+                # 处理期间文档被删除: 已写入的向量已由 process_document 清理
+                await db.rollback()
+                logger.info(f"Ingestion job {job_id} cancelled: document {doc_id} deleted")
+                await db.execute(
+                    self._owned(job_id).values(status="cancelled", finished_at=datetime.utcnow())
+                )
+                await db.commit()
+                return
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"Ingestion job {job_id} failed: {e}")
+                await db.execute(
+                    self._owned(job_id).values(
+                        status="failed",
+                        error_msg=str(e),
+                        finished_at=datetime.utcnow(),
+                    )
+                )
+                await db.execute(
+                    update(Document)
+                    .where(Document.id == doc_id)
+                    .values(status="failed", error_msg=str(e))
+                )
+                await db.commit()
+                return
+
+            await db.execute(
+                self._owned(job_id).values(
+                    status="completed",
+                    stage=None,
+                    progress=100,
+                    metrics=metrics,
+                    finished_at=datetime.utcnow(),
+                )
+            )
+            await db.commit()
+            logger.info(f"Ingestion job {job_id} completed")
+
+
+ingestion_pool = IngestionWorkerPool(settings.INGESTION_WORKERS)
@@ -8,14 +8,15 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from backend.app.models.knowledge_base import KnowledgeBase
 from backend.app.models.document import Document
-from backend.app.core.vector_store import VectorStore
+from backend.app.core.vector_store import get_vector_store
+from backend.app.core.answer_cache import answer_cache
 
 
 class KnowledgeBaseService:
     """知识库服务类"""
 
     def __init__(self):
-        self.vector_store = VectorStore()
+        self.vector_store = get_vector_store()
 
     async def update_kb_statistics(
             self,
@@ -64,6 +65,7 @@ class KnowledgeBaseService:
         try:
             # 删除向量库
             self.vector_store.delete_collection(kb_id)
+            await answer_cache.invalidate_kb(kb_id)
 
             # 删除知识库记录（通过级联删除文档）
             kb_result = await db.execute(
@@ -160,28 +162,44 @@ class KnowledgeBaseService:
         try:
             # 先删除现有向量
             self.vector_store.delete_collection(kb_id)
+            await answer_cache.invalidate_kb(kb_id)
 
-            # 获取知识库中的所有文档
+            # 获取知识库中的所有文档 (只取 ID，逐个文档回滚后 ORM 对象会过期)
             doc_result = await db.execute(
-                select(Document)
+                select(Document.id)
                 .where(Document.kb_id == kb_id)
                 .where(Document.status == "completed")
+                .where(Document.is_deleted == False)
             )
-            documents = doc_result.scalars().all()
-
-            # 重新处理每个文档
-            for doc in documents:
-                # 这里可以调用文档处理服务重新处理文档
-                # 但由于我们可能没有访问doc_service，我们可以直接重新索引
-                from backend.app.services.doc_service import process_document
-                await process_document(db, doc.id)
-
-            logger.info(f"Reindexed knowledge base {kb_id}")
-            return True
+            doc_ids = doc_result.scalars().all()
         except Exception as e:
             logger.error(f"Failed to reindex knowledge base {kb_id}: {str(e)}")
             return False
 
+        from backend.app.services.doc_service import process_document, DocumentDeletedError
+
+        # 逐个文档处理，成功时由 process_document 提交；失败只回滚该文档，不影响其他文档
+        failed = 0
+        for doc_id in doc_ids:
+            try:
+                await process_document(db, doc_id)
+            except DocumentDeletedError:
+                await db.rollback()
+                logger.info(f"Skip reindexing deleted document {doc_id}")
+            except Exception as e:
+                await db.rollback()
+                failed += 1
+                logger.error(f"Failed to reindex document {doc_id}: {str(e)}")
+                await db.execute(
+                    update(Document)
+                    .where(Document.id == doc_id)
+                    .values(status="failed", error_msg=str(e))
+                )
+                await db.commit()
+
+        logger.info(f"Reindexed knowledge base {kb_id}: {len(doc_ids) - failed}/{len(doc_ids)} documents")
+        return failed == 0
+
     async def validate_kb_access(
             self,
             db: AsyncSession,